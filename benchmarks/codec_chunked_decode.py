@@ -0,0 +1,83 @@
+"""Check that the windowed xcodec decode (codec_decode.decode_chunked) gives
+the audio of a whole-track decode, and compare their time and peak memory.
+
+Uses the DAC decoder of xcodec_mini_infer with random weights, at the real
+model's sizes, behind a random codebook lookup in place of the quantizer, so
+no checkpoint is needed. Peak memory is only reported on CUDA.
+
+Usage (from the repository root):
+    python benchmarks/codec_chunked_decode.py --seconds 180 --device cuda
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+inference_dir = Path(__file__).resolve().parent.parent / "inference"
+sys.path.append(str(inference_dir))
+sys.path.append(str(inference_dir / "xcodec_mini_infer"))
+
+import torch
+
+import descriptaudiocodec.dac.model.dac as dac2
+from codec_decode import decode_chunked
+
+frame_rate = 50
+hop_length = 320
+
+
+def timed(decode, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.perf_counter()
+    with torch.no_grad():
+        audio = decode()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        peak = f", peak {torch.cuda.max_memory_allocated(device) / 2**30:.2f} GiB"
+    else:
+        peak = ""
+    return audio, f"{time.perf_counter() - start:.2f}s{peak}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--window_frames", type=int, default=1500)
+    parser.add_argument("--context_frames", type=int, default=50)
+    parser.add_argument("--overlap_frames", type=int, default=10)
+    parser.add_argument("--channels", type=int, default=1024, help="Decoder width (1024 in xcodec).")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    dimension = 256
+    decoder = dac2.Decoder(dimension, args.channels, [8, 5, 4, 2]).to(device).eval()
+    codebooks = torch.randn(8, 1024, dimension, device=device)
+    codebook_index = torch.arange(8, device=device)[:, None, None]
+
+    def decode(codes):
+        # (n_q, B, T) codes to the (B, D, T) sum of their code vectors
+        return decoder(codebooks[codebook_index, codes].sum(0).transpose(1, 2))
+
+    codes = torch.randint(0, 1024, (8, 1, int(args.seconds * frame_rate)), device=device)
+    chunked, report = timed(
+        lambda: decode_chunked(
+            decode,
+            codes,
+            hop_length,
+            window_frames=args.window_frames,
+            context_frames=args.context_frames,
+            overlap_frames=args.overlap_frames,
+        ),
+        device,
+    )
+    print(f"windowed: {report}")
+    full, report = timed(lambda: decode(codes), device)
+    print(f"whole:    {report}")
+    print(f"samples: {chunked.shape[-1]} / {full.shape[-1]}")
+    print(f"max abs difference: {(chunked - full).abs().max().item():.2e}")
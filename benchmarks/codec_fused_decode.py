@@ -0,0 +1,83 @@
+"""Compare the decoder input of SoundStream.decode from the precomputed decode
+table (one gather and sum) with quantizer.decode followed by fc_post2, on
+random codes of stage 2 output lengths, and check that both give the same
+decoder input and audio.
+
+Needs the xcodec checkpoint, like infer.py.
+
+Usage (from the repository root):
+    python benchmarks/codec_fused_decode.py --frames 1500,6000,9000 --device cuda
+"""
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+inference_dir = Path(__file__).resolve().parent.parent / "inference"
+sys.path.append(str(inference_dir))
+sys.path.append(str(inference_dir / "xcodec_mini_infer"))
+
+import torch
+
+from infer import load_codec_model
+
+
+def unfused_input(codec_model, codes):
+    quantized = codec_model.quantizer.decode(codes)
+    return codec_model.fc_post2(quantized.transpose(1, 2)).transpose(1, 2)
+
+
+def timed(function, device, repeats):
+    function()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        output = function()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return output, (time.perf_counter() - start) / repeats * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", default="1500,6000,9000", help="Comma separated track lengths in 50Hz frames.")
+    parser.add_argument("--tracks", type=int, default=2, help="Tracks decoded together (the two stems).")
+    parser.add_argument("--audio_frames", type=int, default=500, help="Frames of the full decode compared for audio.")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument(
+        "--basic_model_config",
+        default=str(inference_dir / "xcodec_mini_infer" / "final_ckpt" / "config.yaml"),
+    )
+    parser.add_argument(
+        "--resume_path",
+        default=str(inference_dir / "xcodec_mini_infer" / "final_ckpt" / "ckpt_00360000.pth"),
+    )
+    parser.add_argument("--cache_dir", default=os.path.join(os.path.expanduser("~"), ".cache", "yue"))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    codec_model = load_codec_model(args.basic_model_config, args.resume_path, device, args.cache_dir)
+
+    with torch.no_grad():
+        for frames in map(int, args.frames.split(",")):
+            codes = torch.randint(0, 1024, (8, args.tracks, frames), device=device)
+            fused, fused_ms = timed(lambda: codec_model.decode_input(codes), device, args.repeats)
+            reference, reference_ms = timed(lambda: unfused_input(codec_model, codes), device, args.repeats)
+            print(
+                f"{frames} frames: table {fused_ms:.2f}ms, quantizer + fc_post2 {reference_ms:.2f}ms, "
+                f"max abs difference {(fused - reference).abs().max().item():.2e}"
+            )
+
+        codes = torch.randint(0, 1024, (8, 1, args.audio_frames), device=device)
+        audio = codec_model.decode(codes)
+        decode_table = codec_model.decode_table
+        codec_model.decode_table = None
+        reference = codec_model.decode(codes)
+        codec_model.decode_table = decode_table
+        print(f"audio max abs difference: {(audio - reference).abs().max().item():.2e}")
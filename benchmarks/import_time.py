@@ -0,0 +1,48 @@
+"""Measure how long it takes to import the inference entry points.
+
+Each measurement runs in a fresh interpreter so nothing is cached between
+runs. "lazy" is what the CLI pays before it can start, "eager" additionally
+loads every dependency the models need, i.e. what importing inference.infer
+used to cost, and "gradio" is the UI module, gradio included.
+
+Usage (from the repository root):
+    python benchmarks/import_time.py --repeat 5
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+repo_dir = Path(__file__).resolve().parent.parent
+
+cases = {
+    "lazy": "import inference.infer",
+    "eager": "import inference.infer; inference.infer.load_dependencies()",
+    "gradio": "import inference.gradio",
+}
+
+
+def time_import(statement):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", statement], cwd=repo_dir, check=True)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # the first run warms the OS file cache for both cases
+    for statement in cases.values():
+        time_import(statement)
+
+    results = {}
+    for name, statement in cases.items():
+        timings = [time_import(statement) for _ in range(args.repeat)]
+        results[name] = statistics.median(timings)
+        print(f"{name:>6}: median {results[name]:.2f}s over {args.repeat} runs")
+    print(f"speedup: {results['eager'] / results['lazy']:.1f}x")
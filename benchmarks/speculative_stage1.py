@@ -0,0 +1,129 @@
+"""Compare plain and speculative stage 1 sampling on tiny random models.
+
+Runs on CPU without any checkpoint. The target is a randomly initialised
+Llama; the draft is built from the target's embeddings, its first
+``--draft_layers`` layers and its head. The output projections of the
+target's other layers are scaled by ``--refine``, which sets how far the
+target strays from the draft and so the acceptance rate, the way a distilled
+draft would be close to but not equal to the real model. Both samplers use
+the settings stage 1 uses (top-p 0.93, guidance 1.5, the codebook grammar).
+Note that with the full mm_tokenizer vocabulary the output head dominates the
+cost of such small models; the speedup on the 7B model is larger.
+
+With ``--offload PROFILE`` (CUDA and mmgp needed) the target is managed by
+``offload.profile`` as in infer.py, and the draft is kept on the GPU next to
+it. ``--draft_in_pipe`` registers the draft with mmgp as well, which swaps
+the target out and back in on every speculation round.
+
+Usage (from the repository root):
+    python benchmarks/speculative_stage1.py --tokens 200 --num_draft_tokens 4
+    python benchmarks/speculative_stage1.py --device cuda --offload 4 --hidden 2048 --layers 24
+"""
+
+import argparse
+import copy
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "inference"))
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from stage1_context import SegmentContext, rotary_inv_freq
+from stage1_sampler import InterleavedCodecGrammar, Stage1Sampler
+from stage1_speculative import SpeculativeStage1Sampler
+
+# mm_tokenizer / xcodec ids
+vocab_size = 83734
+eoa = 32002
+codebook_0 = (45334, 45334 + 1024)
+
+
+def build_models(layers, draft_layers, hidden, refine):
+    config = LlamaConfig(
+        vocab_size=vocab_size,
+        hidden_size=hidden,
+        intermediate_size=hidden * 3,
+        num_hidden_layers=layers,
+        num_attention_heads=max(hidden // 64, 1),
+        max_position_embeddings=16384,
+    )
+    target = LlamaForCausalLM(config).eval()
+    with torch.no_grad():
+        for layer in target.model.layers[draft_layers:]:
+            layer.self_attn.o_proj.weight.mul_(refine)
+            layer.mlp.down_proj.weight.mul_(refine)
+    draft = copy.deepcopy(target)
+    draft.model.layers = draft.model.layers[:draft_layers]
+    draft.config.num_hidden_layers = draft_layers
+    return target, draft
+
+
+def run(sampler, model, prompt, tokens):
+    context = SegmentContext(rotary_inv_freq(model))
+    context.add_segment(prompt, 0)
+    if prompt.is_cuda:
+        torch.cuda.synchronize(prompt.device)
+    start = time.perf_counter()
+    new_ids, _ = sampler.sample(context, 1.5, tokens, min_new_tokens=tokens)
+    if prompt.is_cuda:
+        torch.cuda.synchronize(prompt.device)
+    return new_ids.shape[-1] / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--layers", type=int, default=12)
+    parser.add_argument("--draft_layers", type=int, default=1)
+    parser.add_argument("--hidden", type=int, default=512)
+    parser.add_argument("--refine", type=float, default=0.1)
+    parser.add_argument("--prompt_len", type=int, default=256)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--num_draft_tokens", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument(
+        "--offload", type=int, default=None, help="An mmgp profile to manage the target with."
+    )
+    parser.add_argument("--draft_in_pipe", action="store_true")
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    target, draft = build_models(
+        args.layers, args.draft_layers, args.hidden, args.refine
+    )
+    if args.offload is not None:
+        from mmgp import offload
+
+        pipe = {"transformer": target}
+        if args.draft_in_pipe:
+            pipe["draft"] = draft
+        else:
+            draft.to(device)
+        offload.profile(pipe, profile_no=args.offload, quantizeTransformer=False, verboseLevel=0)
+    else:
+        target.to(device)
+        draft.to(device)
+    prompt = torch.randint(0, 32000, (1, args.prompt_len), device=device)
+    sampler_kwargs = dict(
+        eos_token_id=eoa,
+        grammar=InterleavedCodecGrammar(codebook_0, eoa),
+    )
+    plain = Stage1Sampler(target, **sampler_kwargs)
+    speculative = SpeculativeStage1Sampler(
+        target, draft, num_draft_tokens=args.num_draft_tokens, **sampler_kwargs
+    )
+
+    # warm up both paths once
+    run(plain, target, prompt, 8)
+    run(speculative, target, prompt, 8)
+    speculative.stats = dict.fromkeys(speculative.stats, 0)
+
+    plain_speed = run(plain, target, prompt, args.tokens)
+    speculative_speed = run(speculative, target, prompt, args.tokens)
+    print(f"plain:       {plain_speed:.1f} tokens/s")
+    print(f"speculative: {speculative_speed:.1f} tokens/s")
+    print(speculative.report())
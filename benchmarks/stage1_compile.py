@@ -0,0 +1,86 @@
+"""Compare stage 1 decoding on the dynamic KV cache with the static cache and
+compiled decode step that --compile enables, on a tiny random model.
+
+Runs without any checkpoint. Each sampler decodes ``--runs`` segments of
+``--tokens`` tokens with the settings stage 1 uses (top-p 0.93, guidance 1.5,
+the codebook grammar); the compiled sampler keeps its StaticDecoder across
+them, so the first run pays for compilation and the later ones show the
+steady state. CUDA graphs only pay off on a GPU; on the CPU the compiled
+step mostly measures compilation.
+
+Usage (from the repository root):
+    python benchmarks/stage1_compile.py --tokens 300 --runs 3
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "inference"))
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from stage1_context import SegmentContext, rotary_inv_freq
+from stage1_sampler import InterleavedCodecGrammar, Stage1Sampler
+from stage1_static import StaticDecoder
+
+# mm_tokenizer / xcodec ids
+vocab_size = 83734
+eoa = 32002
+codebook_0 = (45334, 45334 + 1024)
+
+
+def run(sampler, model, prompt, tokens):
+    context = SegmentContext(rotary_inv_freq(model))
+    context.add_segment(prompt, 0)
+    if prompt.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    new_ids, _ = sampler.sample(context, 1.5, tokens, min_new_tokens=tokens)
+    if prompt.is_cuda:
+        torch.cuda.synchronize()
+    return new_ids.shape[-1] / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--layers", type=int, default=12)
+    parser.add_argument("--hidden", type=int, default=512)
+    parser.add_argument("--prompt_len", type=int, default=256)
+    parser.add_argument("--tokens", type=int, default=300)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--no_compile", action="store_true", help="Static cache only, without torch.compile.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dtype = torch.bfloat16 if device.type == "cuda" else torch.float32
+    torch.manual_seed(args.seed)
+    config = LlamaConfig(
+        vocab_size=vocab_size,
+        hidden_size=args.hidden,
+        intermediate_size=args.hidden * 3,
+        num_hidden_layers=args.layers,
+        num_attention_heads=max(args.hidden // 64, 1),
+        max_position_embeddings=16384,
+        attn_implementation="sdpa",
+    )
+    model = LlamaForCausalLM(config).to(device, dtype).eval()
+    prompt = torch.randint(0, 32000, (1, args.prompt_len), device=device)
+    sampler_kwargs = dict(
+        eos_token_id=eoa,
+        grammar=InterleavedCodecGrammar(codebook_0, eoa),
+    )
+    dynamic = Stage1Sampler(model, **sampler_kwargs)
+    static = Stage1Sampler(
+        model,
+        static_decoder=StaticDecoder(model, compile=not args.no_compile),
+        **sampler_kwargs,
+    )
+
+    run(dynamic, model, prompt, 8)  # warm up
+    for name, sampler in (("dynamic", dynamic), ("static", static)):
+        speeds = [run(sampler, model, prompt, args.tokens) for _ in range(args.runs)]
+        print(f"{name:8} " + "  ".join(f"{s:.1f}" for s in speeds) + " tokens/s")
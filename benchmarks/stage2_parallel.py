@@ -0,0 +1,92 @@
+"""Time stage 2 in this process and with Stage2Pool on 1..N CPU processes,
+on a tiny random model, and check that all of them decode the same ids.
+
+Runs without any checkpoint; the model is saved to a temporary folder for the
+worker processes to load. Every worker gets an equal share of the CPU cores,
+so wall time only drops while there are cores left to share; on GPUs list
+one device per process instead (``--devices cuda:0,cuda:1``).
+
+Usage (from the repository root):
+    python benchmarks/stage2_parallel.py --workers 1,2,4 --chunks 16
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "inference"))
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from stage2_decoder import Stage2Decoder
+from stage2_pool import Stage2Pool
+from stage2_scheduler import run_chunks, split_chunks
+
+# mm_tokenizer / xcodec ids
+vocab_size = 83738
+soa, stage_1, stage_2 = 32001, 32013, 32017
+global_offset = 45334
+decoder_config = dict(
+    code_ranges=[
+        (global_offset + k * 1024, global_offset + (k + 1) * 1024) for k in range(1, 8)
+    ],
+    prompt_head=(soa, stage_1),
+    prompt_tail=(stage_2,),
+    code_offset=global_offset,
+)
+
+
+def timed(generate, chunks, batch_size, imap=None):
+    start = time.perf_counter()
+    outputs = run_chunks(chunks, batch_size, generate, imap=imap)
+    return outputs, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--devices", default=None, help="Comma separated devices, instead of --workers CPU processes.")
+    parser.add_argument("--chunks", type=int, default=16)
+    parser.add_argument("--frames", type=int, default=100, help="Frames per chunk (300 in stage 2).")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--hidden", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    config = LlamaConfig(
+        vocab_size=vocab_size,
+        hidden_size=args.hidden,
+        intermediate_size=args.hidden * 3,
+        num_hidden_layers=args.layers,
+        num_attention_heads=max(args.hidden // 64, 1),
+        max_position_embeddings=4096,
+    )
+    model = LlamaForCausalLM(config).eval()
+    codes = torch.randint(0, 1024, (args.chunks * args.frames,))
+    chunks = split_chunks(0, codes, args.frames)
+
+    decoder = Stage2Decoder(model, **decoder_config)
+    reference, seconds = timed(
+        lambda batch: decoder.generate_chunks(batch, "cpu"), chunks, args.batch_size
+    )
+    print(f"in process:  {seconds:.1f}s")
+
+    if args.devices:
+        device_sets = [args.devices.split(",")]
+    else:
+        device_sets = [["cpu"] * int(n) for n in args.workers.split(",")]
+    with tempfile.TemporaryDirectory() as model_dir:
+        model.save_pretrained(model_dir)
+        for devices in device_sets:
+            pool = Stage2Pool(model_dir, devices, decoder_config, torch_dtype="float32")
+            try:
+                outputs, seconds = timed(None, chunks, args.batch_size, pool.imap)
+            finally:
+                pool.close()
+            same = torch.equal(outputs[0], reference[0])
+            print(f"{len(devices)} processes: {seconds:.1f}s, same ids: {same}")
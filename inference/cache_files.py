@@ -0,0 +1,31 @@
+"""File handling shared by the on-disk caches (checkpoints, prompt codes,
+prefix KV caches and stage 2 chunks)."""
+
+import os
+
+
+def write_atomic(path, write, suffix=""):
+    """Write ``path`` by calling ``write`` on a temporary file next to it, which
+    then replaces ``path``, so that readers never see a partial file. ``suffix``
+    ends the temporary name for writers that append their own (np.save)."""
+    tmp_path = f"{path}.{os.getpid()}.tmp{suffix}"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def trim_folder(folder, extension, max_bytes):
+    """Delete the least recently used ``extension`` files of ``folder``, by
+    modification time, until they take at most ``max_bytes``."""
+    if not os.path.isdir(folder):
+        return
+    files = []
+    for name in os.listdir(folder):
+        if name.endswith(extension) and ".tmp" not in name:
+            stat = os.stat(os.path.join(folder, name))
+            files.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in files)
+    for _, size, name in sorted(files):
+        if total <= max_bytes:
+            break
+        os.remove(os.path.join(folder, name))
+        total -= size
@@ -0,0 +1,134 @@
+"""Memory-mapped safetensors copies of the xcodec and vocos checkpoints.
+
+The original ``.pth`` files are pickles: loading one unpickles the whole
+state dict into host RAM before it can be copied into the model. The first
+time a checkpoint is used it is converted into a safetensors file keyed by
+the checkpoint's sha256. Later loads mmap that file and copy one tensor at a
+time straight to the model's device, so the host never holds the full state
+dict.
+
+Checkpoints can be converted ahead of time, e.g. on a node with more RAM:
+    python checkpoint_cache.py xcodec_mini_infer/final_ckpt/ckpt_00360000.pth --key codec_model
+"""
+
+import argparse
+import hashlib
+import json
+import os
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from cache_files import write_atomic
+
+default_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "yue")
+
+
+def file_sha256(path, cache_dir=default_cache_dir):
+    """sha256 of ``path``, remembered per (path, size, mtime) so that large
+    checkpoints are only hashed again when they change."""
+    index_path = os.path.join(cache_dir, "checkpoints", "hashes.json")
+    stat = os.stat(path)
+    entry_key = os.path.abspath(path)
+    entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+    cached = index.get(entry_key)
+    if cached is not None and all(cached.get(k) == v for k, v in entry.items()):
+        return cached["sha256"]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(16 * 1024 * 1024), b""):
+            digest.update(block)
+    entry["sha256"] = digest.hexdigest()
+    index[entry_key] = entry
+
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    def write_index(tmp_path):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, indent=1)
+
+    write_atomic(index_path, write_index)
+    return entry["sha256"]
+
+
+def convert_checkpoint(checkpoint_path, cache_path, key=None):
+    """Write the state dict stored in ``checkpoint_path`` (under ``key`` if
+    given) to ``cache_path`` as safetensors."""
+    try:
+        state_dict = torch.load(
+            checkpoint_path, map_location="cpu", weights_only=False, mmap=True
+        )
+    except RuntimeError:
+        # legacy (non zip) checkpoints cannot be mmapped
+        state_dict = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+    if key is not None:
+        state_dict = state_dict[key]
+
+    # safetensors refuses tensors that share storage, give duplicates their own
+    tensors = {}
+    storages = set()
+    for name, tensor in state_dict.items():
+        tensor = tensor.contiguous()
+        storage = tensor.untyped_storage().data_ptr()
+        if storage in storages:
+            tensor = tensor.clone()
+        storages.add(storage)
+        tensors[name] = tensor
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    write_atomic(cache_path, lambda tmp_path: save_file(tensors, tmp_path))
+
+
+def cached_checkpoint_path(checkpoint_path, key=None, cache_dir=default_cache_dir):
+    """Path of the safetensors copy of ``checkpoint_path``, converting it first
+    if it does not exist yet."""
+    digest = file_sha256(checkpoint_path, cache_dir)
+    name = digest[:32] + (f"-{key}" if key else "") + ".safetensors"
+    cache_path = os.path.join(cache_dir, "checkpoints", name)
+    if not os.path.exists(cache_path):
+        print(f"Converting {checkpoint_path} to {cache_path}")
+        convert_checkpoint(checkpoint_path, cache_path, key)
+    return cache_path
+
+
+def load_state_dict(module, checkpoint_path, key=None, cache_dir=default_cache_dir):
+    """Load ``checkpoint_path`` into ``module`` through the safetensors cache.
+
+    Behaves like ``module.load_state_dict(..., strict=True)``, but tensors are
+    read from the mmapped cache one by one directly onto the device the module
+    already lives on.
+    """
+    cache_path = cached_checkpoint_path(checkpoint_path, key, cache_dir)
+    state = module.state_dict()
+    device = next(module.parameters()).device
+    with safe_open(cache_path, framework="pt", device=str(device)) as f:
+        names = set(f.keys())
+        missing = sorted(state.keys() - names)
+        unexpected = sorted(names - state.keys())
+        if missing or unexpected:
+            raise RuntimeError(
+                f"Error(s) in loading state_dict for {module.__class__.__name__} from {checkpoint_path}: "
+                f"missing keys {missing}, unexpected keys {unexpected}"
+            )
+        with torch.no_grad():
+            for name in names:
+                state[name].copy_(f.get_tensor(name))
+    return module
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoints", nargs="+", help="The .pth files to convert.")
+    parser.add_argument(
+        "--key", default=None, help="Entry of the checkpoint holding the state dict."
+    )
+    parser.add_argument("--cache_dir", default=default_cache_dir)
+    args = parser.parse_args()
+    for path in args.checkpoints:
+        print(cached_checkpoint_path(path, args.key, args.cache_dir))
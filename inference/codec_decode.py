@@ -0,0 +1,105 @@
+"""Decoding xcodec codes to audio in bounded memory.
+
+``SoundStream.decode`` turns a whole track into audio at once, and the
+activations of its convolutional decoder grow with the length of the song.
+``decode_chunked`` decodes windows of ``window_frames`` frames instead. Each
+window is decoded with ``context_frames`` extra frames on both sides, which
+are cut off again, so that its audio matches the one of a full decode up to
+float error. Consecutive windows overlap by ``overlap_frames`` frames, and a
+linear crossfade over the overlap hides what is left of the seams.
+
+``decode_batch`` does the same for many tracks of any lengths (both stems of
+every song of a batch) and decodes their windows together, ``batch_size`` at
+a time. Only windows of the same length share a call, so no window is padded
+and every track comes out as if it had been decoded alone.
+"""
+
+import torch
+
+
+def plan_windows(num_frames, window_frames, context_frames, overlap_frames):
+    """The (first, last, start, end) frames of the windows of a track: the
+    codes first:last are decoded and the audio of start:end is kept. One
+    window for the whole track if it is short or ``window_frames`` is 0."""
+    if window_frames <= 0 or num_frames <= window_frames + overlap_frames:
+        return [(0, num_frames, 0, num_frames)]
+    windows = []
+    start = 0
+    while True:
+        end = min(start + window_frames + overlap_frames, num_frames)
+        first = max(start - context_frames, 0)
+        last = min(end + context_frames, num_frames)
+        windows.append((first, last, start, end))
+        if end == num_frames:
+            return windows
+        start += window_frames
+
+
+def crossfade(pieces, fade):
+    """Join the audio ``pieces`` of a track, which overlap by ``fade`` samples."""
+    audio = pieces[0]
+    for piece in pieces[1:]:
+        weight = (torch.arange(fade, device=piece.device, dtype=piece.dtype) + 0.5) / fade
+        tail = audio[..., -fade:] * (1 - weight) + piece[..., :fade] * weight
+        audio = torch.cat([audio[..., :-fade], tail, piece[..., fade:]], dim=-1)
+    return audio
+
+
+def decode_batch(
+    decode,
+    tracks,
+    hop_length,
+    batch_size=4,
+    window_frames=1500,
+    context_frames=50,
+    overlap_frames=10,
+):
+    """``decode`` (e.g. ``SoundStream.decode``) on a list of (n_q, T) codes of
+    any lengths, as (n_q, B, T) batches of windows. Returns the (1, samples)
+    audio of every track."""
+    hop_length = int(hop_length)
+    pieces = []
+    by_length = {}
+    for track, codes in enumerate(tracks):
+        windows = plan_windows(codes.shape[-1], window_frames, context_frames, overlap_frames)
+        pieces.append([None] * len(windows))
+        for index, (first, last, start, end) in enumerate(windows):
+            by_length.setdefault(last - first, []).append((track, index, first, last, start, end))
+
+    for windows in by_length.values():
+        for offset in range(0, len(windows), batch_size):
+            batch = windows[offset : offset + batch_size]
+            codes = torch.stack(
+                [tracks[track][:, first:last] for track, _, first, last, _, _ in batch], dim=1
+            )
+            for (track, index, first, _, start, end), piece in zip(batch, decode(codes)):
+                begin = (start - first) * hop_length
+                if end == tracks[track].shape[-1]:
+                    # up to the end, which may be a few samples short of T * hop
+                    pieces[track][index] = piece[..., begin:]
+                else:
+                    pieces[track][index] = piece[..., begin : begin + (end - start) * hop_length]
+    return [crossfade(track_pieces, overlap_frames * hop_length) for track_pieces in pieces]
+
+
+def decode_chunked(
+    decode,
+    codes,
+    hop_length,
+    window_frames=1500,
+    context_frames=50,
+    overlap_frames=10,
+):
+    """``decode`` on the (n_q, B, T) ``codes``, one window at a time. Returns
+    the (B, 1, samples) audio."""
+    return torch.stack(
+        decode_batch(
+            decode,
+            list(codes.unbind(1)),
+            hop_length,
+            codes.shape[1],
+            window_frames,
+            context_frames,
+            overlap_frames,
+        )
+    )
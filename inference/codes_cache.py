@@ -0,0 +1,152 @@
+"""Content addressed cache of the xcodec codes of audio prompts.
+
+In ICL mode every run sends the reference tracks through the HuBERT semantic
+model and the acoustic encoder of xcodec. The codes only depend on the audio,
+the encode parameters and the codec checkpoint, so they are kept in
+``<cache_dir>/codes/<key>.npy`` with a key hashing all three, and a reference
+track is encoded once no matter where it is stored or how it is named.
+
+A folder of reference tracks can be encoded ahead of time, one track at a
+time while the next ones are decoded from disk:
+    python codes_cache.py ../prompt_egs --out_dir ../prompt_codes
+``--out_dir`` additionally writes the codes of ``<folder>/a/x.wav`` to
+``<out_dir>/a/x.wav.npy``, files that can be given instead of the audio as
+--audio_prompt_path, --vocal_track_prompt_path or
+--instrumental_track_prompt_path.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import queue
+import threading
+from pathlib import Path
+
+import numpy as np
+
+import checkpoint_cache
+from cache_files import write_atomic
+
+audio_extensions = (".wav", ".mp3", ".flac", ".ogg", ".m4a")
+
+
+def codes_key(audio_path, codec_checkpoint, params, cache_dir=checkpoint_cache.default_cache_dir):
+    digest = hashlib.sha256()
+    with open(audio_path, "rb") as f:
+        for block in iter(lambda: f.read(16 * 1024 * 1024), b""):
+            digest.update(block)
+    key = {
+        "audio": digest.hexdigest(),
+        "codec": checkpoint_cache.file_sha256(codec_checkpoint, cache_dir),
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def codes_path(key, cache_dir=checkpoint_cache.default_cache_dir):
+    return os.path.join(cache_dir, "codes", f"{key}.npy")
+
+
+def load_codes(key, cache_dir=checkpoint_cache.default_cache_dir):
+    path = codes_path(key, cache_dir)
+    if not os.path.exists(path):
+        return None
+    return np.load(path)
+
+
+def save_codes(key, codes, cache_dir=checkpoint_cache.default_cache_dir):
+    path = codes_path(key, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomic(path, lambda tmp_path: np.save(tmp_path, codes), ".npy")
+
+
+def read_codes(path, codebook_size=1024):
+    """Codes given directly as a ``.npy`` file, (n_q, T) or (1, n_q, T), as
+    the (1, n_q, T) int16 array ``encode_audio`` returns."""
+    codes = np.load(path)
+    if codes.ndim == 2:
+        codes = codes[None]
+    if codes.ndim != 3 or codes.shape[0] != 1:
+        raise ValueError(f"{path}: expected codes of shape (n_q, T) or (1, n_q, T), got {codes.shape}")
+    if codes.min() < 0 or codes.max() >= codebook_size:
+        raise ValueError(f"{path}: codes must lie in [0, {codebook_size})")
+    return codes.astype(np.int16)
+
+
+if __name__ == "__main__":
+    import torch
+
+    from infer import create_args, encode_audio, load_audio_mono, load_codec_model, load_dependencies
+
+    load_dependencies()
+    defaults, _ = create_args()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder", help="Folder with the reference tracks, searched recursively.")
+    parser.add_argument(
+        "--out_dir", default=None, help="Also write <track path relative to folder>.npy files here."
+    )
+    parser.add_argument("--basic_model_config", default=defaults.basic_model_config)
+    parser.add_argument("--resume_path", default=defaults.resume_path)
+    parser.add_argument("--cache_dir", default=defaults.cache_dir)
+    parser.add_argument("--cuda_idx", type=int, default=0)
+    args = parser.parse_args()
+
+    device = torch.device(f"cuda:{args.cuda_idx}" if torch.cuda.is_available() else "cpu")
+    # the parameters infer.py encodes audio prompts with
+    params = {"sampling_rate": 16000, "target_bw": 0.5}
+    paths = sorted(
+        str(p) for p in Path(args.folder).rglob("*") if p.suffix.lower() in audio_extensions
+    )
+
+    def write_out(path, codes):
+        # the full relative name, so that a/x.wav, a/x.mp3 and b/x.wav do not collide
+        out_path = Path(args.out_dir) / (str(Path(path).relative_to(args.folder)) + ".npy")
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        np.save(out_path, codes)
+
+    todo = []
+    for path in paths:
+        key = codes_key(path, args.resume_path, params, args.cache_dir)
+        codes = load_codes(key, args.cache_dir)
+        if codes is None:
+            todo.append((path, key))
+        elif args.out_dir:
+            write_out(path, codes)
+    print(f"{len(paths) - len(todo)} of {len(paths)} tracks already encoded.")
+
+    # decode and resample on a thread while the codec encodes
+    loaded = queue.Queue(maxsize=4)
+
+    def loader():
+        try:
+            for path, key in todo:
+                try:
+                    audio = load_audio_mono(path, params["sampling_rate"])
+                except Exception as error:
+                    raise RuntimeError(f"Could not load {path}") from error
+                loaded.put((path, key, audio))
+        except Exception as error:
+            # raised again by the encode loop, which would otherwise wait forever
+            loaded.put(error)
+        else:
+            loaded.put(None)
+
+    threading.Thread(target=loader, daemon=True).start()
+    codec_model = load_codec_model(args.basic_model_config, args.resume_path, device, args.cache_dir)
+
+    # Whole tracks are encoded one at a time: they hardly ever have the same
+    # length, and HuBERT gets no attention mask, so padding them to batch
+    # them would change the codes.
+    while True:
+        item = loaded.get()
+        if item is None:
+            break
+        if isinstance(item, Exception):
+            raise item
+        path, key, audio = item
+        codes = encode_audio(codec_model, audio, device, target_bw=params["target_bw"])
+        save_codes(key, codes, args.cache_dir)
+        if args.out_dir:
+            write_out(path, codes)
+        print(path)
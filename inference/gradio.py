@@ -1,12 +1,58 @@
 import gradio as gr
 import os
-from inference.infer import create_args, main
+import gc
+import subprocess
+import threading
+from inference.infer import create_args, YuEEngine
 from pathlib import Path
-import torch
 import json
 import random
 
 
+# The engine keeps every model resident between clicks; it is only rebuilt
+# when a request asks for different weights (e.g. another stage 1 model) or
+# cache settings.
+engine = None
+engine_lock = threading.Lock()
+
+
+def get_engine(args):
+    import torch
+
+    global engine
+    if engine is None or not engine.matches(args):
+        if engine is not None:
+            engine.close()
+        engine = None
+        gc.collect()
+        torch.cuda.empty_cache()
+        engine = YuEEngine(args)
+    return engine
+
+
+def gpu_memory_gb():
+    """Total memory of every visible GPU in GB. Asks nvidia-smi, so that
+    building the UI does not import torch."""
+    try:
+        output = subprocess.run(
+            ["nvidia-smi", "--query-gpu=memory.total", "--format=csv,noheader,nounits"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    memory = [int(line) / 1024 for line in output.split()]
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible is not None:
+        memory = [
+            memory[int(index)]
+            for index in visible.split(",")
+            if index.strip().isdigit() and int(index) < len(memory)
+        ]
+    return memory
+
+
 def generate_music(
     genre_txt,
     lyrics_txt,
@@ -64,7 +110,8 @@ def generate_music(
     )
 
     # Generate music
-    output_audio = main(args)
+    with engine_lock:
+        output_audio = get_engine(args).generate(args)
 
     # Return the generated audio files
     return output_audio
@@ -136,6 +183,8 @@ def clear_tags():
 
 
 # Create the Gradio interface
+gpu_memory = gpu_memory_gb()
+
 with gr.Blocks(
     theme=gr.themes.Glass(
         primary_hue="green",
@@ -260,11 +309,7 @@ with gr.Blocks(
                 with gr.Row():
                     stage2_batch_size = gr.Number(
                         label="Stage 2 Batch Size",
-                        value=round(
-                            torch.cuda.get_device_properties(0).total_memory
-                            / (1024 * 1024 * 1024)
-                        )
-                        / 6,
+                        value=round(gpu_memory[0]) / 6 if gpu_memory else 1,
                         precision=0,
                         minimum=1,
                         maximum=10,
@@ -272,7 +317,7 @@ with gr.Blocks(
                     )
                     cuda_idx = gr.Radio(
                         label="CUDA Index",
-                        choices=[str(i) for i in range(torch.cuda.device_count())],
+                        choices=[str(i) for i in range(max(len(gpu_memory), 1))],
                         value="0",
                         type="index",
                     )
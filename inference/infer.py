@@ -1,7 +1,6 @@
 import os
 import sys
 from pathlib import Path
-from mmgp import offload
 
 # Add paths for xcodec modules
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -13,29 +12,70 @@ import re
 import random
 import uuid
 import copy
+import json
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from tqdm import tqdm
-from collections import Counter
 import argparse
 import numpy as np
-import torch
-import torchaudio
-from torchaudio.transforms import Resample
-import soundfile as sf
 from einops import rearrange
-from transformers import (
-    AutoModelForCausalLM,
-    LogitsProcessor,
-    LogitsProcessorList,
-    BitsAndBytesConfig,
-)
-from omegaconf import OmegaConf
 from codecmanipulator import CodecManipulator
 from mmtokenizer import _MMSentencePieceTokenizer
-import copy
-from collections import Counter
-from models.soundstream_hubert_new import SoundStream
-from vocoder import build_codec_model, process_audio
-from post_process_audio import replace_low_freq_with_energy_matched
+
+
+# context window of the stage 1 model, in tokens
+stage1_context_length = 16384
+
+
+def load_dependencies():
+    """Import torch, transformers, mmgp and the xcodec / vocoder modules.
+
+    They take several seconds to import, so this module only pulls them in
+    when the first model is about to be used. ``create_args`` and the gradio
+    UI work without them.
+    """
+    global offload, torch, torchaudio, Resample, sf, OmegaConf
+    global AutoModelForCausalLM, BitsAndBytesConfig
+    global SoundStream, VocosDecoder, checkpoint_cache
+    global replace_low_freq_with_energy_matched
+    global SegmentContext, rotary_inv_freq, Stage1Sampler, InterleavedCodecGrammar
+    global SpeculativeStage1Sampler, PrefixCache, codes_cache, Stage1Streamer
+    global plan_budgets, budget_report, StaticDecoder, Stage2Decoder
+    global split_chunks, run_chunks, ChunkCache, Stage2Pool, decode_batch
+    if "torch" in globals():
+        return
+
+    from mmgp import offload
+    import torch
+    import torchaudio
+    from torchaudio.transforms import Resample
+    import soundfile as sf
+    from transformers import (
+        AutoModelForCausalLM,
+        BitsAndBytesConfig,
+    )
+    from omegaconf import OmegaConf
+    from models.soundstream_hubert_new import SoundStream
+    from vocos import VocosDecoder
+    import checkpoint_cache
+    import codes_cache
+    from stage1_context import SegmentContext, rotary_inv_freq
+    from stage1_sampler import Stage1Sampler, InterleavedCodecGrammar
+    from stage1_speculative import SpeculativeStage1Sampler
+    from stage1_static import StaticDecoder
+    from stage2_decoder import Stage2Decoder
+    from stage2_scheduler import split_chunks, run_chunks
+    from stage2_cache import ChunkCache
+    from stage2_pool import Stage2Pool
+    from codec_decode import decode_batch
+    from prefix_cache import PrefixCache
+    from stage1_stream import Stage1Streamer
+    from segment_budget import plan_budgets, budget_report
+    from post_process_audio import replace_low_freq_with_energy_matched
 
 
 def create_args(
@@ -58,6 +98,7 @@ def create_args(
     disable_offload_model: bool = True,
     cuda_idx: int = 0,
     seed: int = 42,
+    num_variations: int = 1,
     basic_model_config: str = (
         Path(current_dir) / "xcodec_mini_infer/final_ckpt/config.yaml"
     ).as_posix(),
@@ -74,7 +115,7 @@ def create_args(
         Path(current_dir) / "xcodec_mini_infer/decoders/decoder_151000.pth"
     ).as_posix(),
     rescale: bool = False,
-    compile: bool = True,
+    compile: bool = False,
     profile: int = 3,
 ) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
@@ -91,12 +132,30 @@ def create_args(
         default="m-a-p/YuE-s2-1B-general",
         help="The model checkpoint path or identifier for the Stage 2 model.",
     )
+    parser.add_argument(
+        "--draft_model",
+        type=str,
+        default=None,
+        help="A small causal LM over the mm_tokenizer vocabulary. If set, it proposes the Stage 1 tokens and the Stage 1 model verifies them (speculative decoding); the output follows the same distribution. The draft stays on the GPU whatever the --profile.",
+    )
+    parser.add_argument(
+        "--num_draft_tokens",
+        type=int,
+        default=4,
+        help="The number of tokens the draft model proposes per Stage 1 forward pass.",
+    )
     parser.add_argument(
         "--max_new_tokens",
         type=int,
         default=3000,
         help="The maximum number of new tokens to generate in one pass during text generation.",
     )
+    parser.add_argument(
+        "--budget_margin",
+        type=float,
+        default=None,
+        help="Cap every Stage 1 segment at this multiple of the tokens its lyrics are expected to take (never above --max_new_tokens), e.g. 1.5. Off by default, as the pace the estimate assumes is not calibrated yet: every segment gets --max_new_tokens.",
+    )
     parser.add_argument(
         "--run_n_segments",
         type=int,
@@ -107,19 +166,19 @@ def create_args(
         "--stage2_batch_size",
         type=int,
         default=4,
-        help="The batch size used in Stage 2 inference.",
+        help="The number of 6 second chunks Stage 2 decodes at once. Chunks and ragged tails of both tracks, all variations and (with --batch_jsonl) every song ready at the time are batched together.",
     )
     # Prompt
     parser.add_argument(
         "--genre_txt",
         type=str,
-        required=True,
+        default=None,
         help="The file path to a text file containing genre tags that describe the musical style or characteristics (e.g., instrumental, genre, mood, vocal timbre, vocal gender). This is used as part of the generation prompt.",
     )
     parser.add_argument(
         "--lyrics_txt",
         type=str,
-        required=True,
+        default=None,
         help="The file path to a text file containing the lyrics for the music generation. These lyrics will be processed and split into structured segments to guide the generation process.",
     )
     parser.add_argument(
@@ -131,7 +190,7 @@ def create_args(
         "--audio_prompt_path",
         type=str,
         default="",
-        help="The file path to an audio file to use as a reference prompt when --use_audio_prompt is enabled.",
+        help="The file path to an audio file to use as a reference prompt when --use_audio_prompt is enabled, or to its precomputed xcodec codes as a .npy file (see codes_cache.py).",
     )
     parser.add_argument(
         "--prompt_start_time",
@@ -154,13 +213,13 @@ def create_args(
         "--vocal_track_prompt_path",
         type=str,
         default="",
-        help="The file path to a vocal track file to use as a reference prompt when --use_dual_tracks_prompt is enabled.",
+        help="The file path to a vocal track file (or its xcodec codes as a .npy file) to use as a reference prompt when --use_dual_tracks_prompt is enabled.",
     )
     parser.add_argument(
         "--instrumental_track_prompt_path",
         type=str,
         default="",
-        help="The file path to an instrumental track file to use as a reference prompt when --use_dual_tracks_prompt is enabled.",
+        help="The file path to an instrumental track file (or its xcodec codes as a .npy file) to use as a reference prompt when --use_dual_tracks_prompt is enabled.",
     )
     # Output
     parser.add_argument(
@@ -172,7 +231,7 @@ def create_args(
     parser.add_argument(
         "--keep_intermediate",
         action="store_true",
-        help="If set, intermediate outputs will be saved during processing.",
+        help="If set, the stage 1 and stage 2 codes are also saved as .npy files in the stage1 and stage2 folders of --output_dir. They are handed between stages in memory either way.",
     )
     parser.add_argument(
         "--disable_offload_model",
@@ -183,6 +242,12 @@ def create_args(
     parser.add_argument(
         "--seed", type=int, default=42, help="An integer value to reproduce generation."
     )
+    parser.add_argument(
+        "--num_variations",
+        type=int,
+        default=1,
+        help="The number of takes of the song to generate. The shared prompt is prefilled once and the takes are sampled as one batch in stage 1; each take is written to <output_dir>/variation_<n>.",
+    )
     # Config for xcodec and upsampler
     parser.add_argument(
         "--basic_model_config",
@@ -226,7 +291,59 @@ def create_args(
         "-r", "--rescale", action="store_true", help="Rescale output to avoid clipping."
     )
     parser.add_argument("--profile", type=int, default=3)
-    parser.add_argument("--compile", action="store_true", help="Compile model.")
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=os.path.join(os.path.expanduser("~"), ".cache", "yue"),
+        help="Directory for the safetensors copies of the xcodec and vocos checkpoints and for spilled prompt caches.",
+    )
+    parser.add_argument(
+        "--prefix_cache_ram_gb",
+        type=float,
+        default=4,
+        help="Host RAM kept for the KV caches of prefilled Stage 1 prompts, so that re-runs with another seed or sampling settings skip the prefill.",
+    )
+    parser.add_argument(
+        "--prefix_cache_disk_gb",
+        type=float,
+        default=0,
+        help="Disk space under --cache_dir for prefilled prompt KV caches that do not fit in RAM. 0 disables spilling to disk.",
+    )
+    parser.add_argument(
+        "--stage2_devices",
+        type=str,
+        default=None,
+        help="Comma separated devices for data parallel stage 2, one process with its own copy of the Stage 2 model per entry, e.g. cuda:0,cuda:1 or cpu,cpu,cpu,cpu. By default Stage 2 runs in this process on --cuda_idx.",
+    )
+    parser.add_argument(
+        "--stage2_cache_gb",
+        type=float,
+        default=2,
+        help="Disk space under --cache_dir for the outputs of finished 6 second stage 2 chunks, keyed by their codes and the stage 2 model. A crashed or repeated run resumes from them. 0 disables the cache.",
+    )
+    parser.add_argument(
+        "--codec_window_frames",
+        type=int,
+        default=1500,
+        help="Decode each track with the xcodec decoder in overlapping windows of this many 50Hz frames (30 seconds by default), so that its memory does not grow with the song length. 0 decodes whole tracks at once.",
+    )
+    parser.add_argument(
+        "--codec_batch_size",
+        type=int,
+        default=4,
+        help="Windows of --codec_window_frames frames decoded together by the xcodec decoder, taken from both stems of every song that finished stage 2 together.",
+    )
+    parser.add_argument(
+        "--batch_jsonl",
+        type=str,
+        default=None,
+        help="A JSONL file with one song request per line (genre, lyrics, seed, segments, prompt audio). All songs are rendered with the same loaded models, and stage 1 of the next song overlaps the codec decode and vocoder of the current one (and stage 2 too with --stage2_devices).",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Run the stage 1 decode steps on a static KV cache, preallocated for the whole planned song, with a torch.compile'd step (CUDA graphs). Without it the KV cache grows token by token. The first segment pays for compilation; later segments and requests reuse the graph. The stage 1 model then uses SDPA attention instead of flash-attn.",
+    )
 
     args = parser.parse_args(
         [
@@ -260,6 +377,8 @@ def create_args(
             inst_decoder_path,
             "--seed",
             str(seed),
+            "--num_variations",
+            str(num_variations),
         ]
     )
     if use_audio_prompt:
@@ -285,629 +404,1058 @@ def create_args(
     return args, parser
 
 
-def main(args):
-    stage1_model = args.stage1_model
-    stage2_model = args.stage2_model
-    cuda_idx = args.cuda_idx
-    max_new_tokens = args.max_new_tokens
-    stage1_output_dir = os.path.join(args.output_dir, f"stage1")
-    stage2_output_dir = stage1_output_dir.replace("stage1", "stage2")
-    os.makedirs(stage1_output_dir, exist_ok=True)
-    os.makedirs(stage2_output_dir, exist_ok=True)
-
-    def seed_everything(seed=42):
-        random.seed(seed)
-        np.random.seed(seed)
-        torch.manual_seed(seed)
-        torch.cuda.manual_seed_all(seed)
-        torch.backends.cudnn.deterministic = True
-        torch.backends.cudnn.benchmark = False
-
-    seed_everything(args.seed)
-
-    # load tokenizer and model
-    device = torch.device(f"cuda:{cuda_idx}" if torch.cuda.is_available() else "cpu")
-    print(device)
-    mmtokenizer = _MMSentencePieceTokenizer(
-        (Path(current_dir) / "mm_tokenizer_v0.2_hf" / "tokenizer.model").as_posix()
-    )
-
-    def load_model(model_path, quantization):
-        if quantization == "bf16":
-            model = AutoModelForCausalLM.from_pretrained(
-                model_path,
-                torch_dtype=torch.bfloat16,
-                attn_implementation="flash_attention_2",  # To enable flashattn, you have to install flash-attn
-            )
-            model.to("cpu")
-        elif quantization == "int8":
-            bnb_config = BitsAndBytesConfig(
-                load_in_8bit=True  # Enable 8-bit quantization
-            )
+def seed_everything(seed=42):
+    load_dependencies()
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+    torch.backends.cudnn.deterministic = True
+    torch.backends.cudnn.benchmark = False
 
-            model = AutoModelForCausalLM.from_pretrained(
-                model_path,
-                quantization_config=bnb_config,
-                attn_implementation="flash_attention_2",
-            )
-        elif quantization == "int4":
-            bnb_config = BitsAndBytesConfig(
-                load_in_4bit=True  # Enable 4-bit quantization
-            )
 
-            model = AutoModelForCausalLM.from_pretrained(
-                model_path,
-                quantization_config=bnb_config,
-                attn_implementation="flash_attention_2",
-            )
-        return model
+def load_model(model_path, quantization, attn_implementation="flash_attention_2"):
+    load_dependencies()
+    if quantization == "bf16":
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            torch_dtype=torch.bfloat16,
+            attn_implementation=attn_implementation,  # To enable flashattn, you have to install flash-attn
+        )
+        model.to("cpu")
+    elif quantization == "int8":
+        bnb_config = BitsAndBytesConfig(
+            load_in_8bit=True  # Enable 8-bit quantization
+        )
 
-    model = load_model(
-        stage1_model, "int8" if stage1_model.endswith("int8") else "bf16"
-    )
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            quantization_config=bnb_config,
+            attn_implementation=attn_implementation,
+        )
+    elif quantization == "int4":
+        bnb_config = BitsAndBytesConfig(
+            load_in_4bit=True  # Enable 4-bit quantization
+        )
 
-    # to device, if gpu is available
-    model.eval()
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            quantization_config=bnb_config,
+            attn_implementation=attn_implementation,
+        )
+    return model
+
+
+def load_audio_mono(filepath, sampling_rate=16000):
+    load_dependencies()
+    audio, sr = torchaudio.load(filepath)
+    # Convert to mono
+    audio = torch.mean(audio, dim=0, keepdim=True)
+    # Resample if needed
+    if sr != sampling_rate:
+        resampler = Resample(orig_freq=sr, new_freq=sampling_rate)
+        audio = resampler(audio)
+    return audio
+
+
+def encode_audio(codec_model, audio_prompt, device, target_bw=0.5):
+    load_dependencies()
+    if len(audio_prompt.shape) < 3:
+        audio_prompt.unsqueeze_(0)
+    with torch.no_grad():
+        raw_codes = codec_model.encode(audio_prompt.to(device), target_bw=target_bw)
+    raw_codes = raw_codes.transpose(0, 1)
+    raw_codes = raw_codes.cpu().numpy().astype(np.int16)
+    return raw_codes
+
+
+def load_prompt_codes(codec_model, path, device, args, target_bw=0.5):
+    """xcodec codes (1, n_q, T) of the audio prompt ``path``. ``.npy`` files
+    hold precomputed codes; audio files go through the codes cache."""
+    load_dependencies()
+    if path.endswith(".npy"):
+        return codes_cache.read_codes(path)
+    key = codes_cache.codes_key(
+        path,
+        args.resume_path,
+        {"sampling_rate": 16000, "target_bw": target_bw},
+        args.cache_dir,
+    )
+    raw_codes = codes_cache.load_codes(key, args.cache_dir)
+    if raw_codes is None:
+        raw_codes = encode_audio(
+            codec_model, load_audio_mono(path), device, target_bw=target_bw
+        )
+        codes_cache.save_codes(key, raw_codes, args.cache_dir)
+    return raw_codes
 
-    # if torch.__version__ >= "2.0.0":
-    #     model_stage2 = torch.compile(model)
 
-    model_stage2 = AutoModelForCausalLM.from_pretrained(
-        stage2_model,
-        torch_dtype=torch.bfloat16,
-        attn_implementation="flash_attention_2",
-        # device_map="auto",
+def load_codec_model(basic_model_config, resume_path, device, cache_dir):
+    load_dependencies()
+    model_config = OmegaConf.load(basic_model_config)
+    codec_model = eval(model_config.generator.name)(
+        **model_config.generator.config
+    ).to(device)
+    checkpoint_cache.load_state_dict(codec_model, resume_path, "codec_model", cache_dir)
+    codec_model.eval()
+    codec_model.build_decode_table()
+    return codec_model
+
+
+def split_lyrics(lyrics):
+    pattern = r"\[(\w+)\](.*?)(?=\[|\Z)"
+    segments = re.findall(pattern, lyrics, re.DOTALL)
+    structured_lyrics = [f"[{seg[0]}]\n{seg[1].strip()}\n\n" for seg in segments]
+    return structured_lyrics
+
+
+# convert audio tokens to audio
+def save_audio(wav: "torch.Tensor", path, sample_rate: int, rescale: bool = False):
+    load_dependencies()
+    folder_path = os.path.dirname(path)
+    if not os.path.exists(folder_path):
+        os.makedirs(folder_path)
+    limit = 0.99
+    max_val = wav.abs().max()
+    wav = wav * min(limit / max_val, 1) if rescale else wav.clamp(-limit, limit)
+    torchaudio.save(
+        str(path),
+        wav,
+        sample_rate=sample_rate,
+        encoding="PCM_S",
+        bits_per_sample=16,
     )
-    model_stage2.to("cpu")
-    model_stage2.eval()
 
-    pipe = {"transformer": model, "stage2": model_stage2}
 
-    quantizeTransformer = args.profile == 3 or args.profile == 4 or args.profile == 5
-
-    codectool = CodecManipulator("xcodec", 0, 1)
-    codectool_stage2 = CodecManipulator("xcodec", 0, 8)
-    model_config = OmegaConf.load(args.basic_model_config)
-    codec_model = eval(model_config.generator.name)(**model_config.generator.config).to(
-        device
-    )
-    parameter_dict = torch.load(
-        args.resume_path, map_location="cpu", weights_only=False
+class Stage1Cancelled(Exception):
+    """Raised inside stage 1 when the consumer of ``stream_stage1`` is gone."""
+
+
+# The codes of one track handed from a stage to the next: ``codes`` is an
+# (n_q, T) tensor on the engine's device, ``name`` ends with _vtrack or _itrack
+# and ``path`` is the .npy copy written with --keep_intermediate, or None.
+TrackCodes = namedtuple("TrackCodes", "name codes path")
+
+
+class YuEEngine:
+    """Resident YuE pipeline.
+
+    Loads the stage 1 / stage 2 language models, the xcodec model, the
+    vocos decoders and the tokenizers once, so that ``generate`` only pays
+    for the actual inference of each request.
+    """
+
+    # Arguments that decide which weights and caches are resident, read only
+    # when the engine is built. A request whose values differ from the ones
+    # the engine was built with needs a new engine.
+    resident_args = (
+        "stage1_model",
+        "draft_model",
+        "stage2_model",
+        "stage2_devices",
+        "cuda_idx",
+        "profile",
+        "compile",
+        "basic_model_config",
+        "resume_path",
+        "config_path",
+        "vocal_decoder_path",
+        "inst_decoder_path",
+        "cache_dir",
+        "prefix_cache_ram_gb",
+        "prefix_cache_disk_gb",
+        "stage2_cache_gb",
     )
-    codec_model.load_state_dict(parameter_dict["codec_model"])
-    del parameter_dict
-    codec_model.to(device)
-    codec_model.eval()
 
-    print("profile:"+ str(args.profile))
-
-    offload.profile(
-        pipe,
-        profile_no=args.profile,
-        quantizeTransformer=quantizeTransformer,
-        compile=False,
-        verboseLevel=1,
-    )
-
-    class BlockTokenRangeProcessor(LogitsProcessor):
-        def __init__(self, start_id, end_id):
-            self.blocked_token_ids = list(range(start_id, end_id))
-
-        def __call__(self, input_ids, scores):
-            scores[:, self.blocked_token_ids] = -float("inf")
-            return scores
-
-    def load_audio_mono(filepath, sampling_rate=16000):
-        audio, sr = torchaudio.load(filepath)
-        # Convert to mono
-        audio = torch.mean(audio, dim=0, keepdim=True)
-        # Resample if needed
-        if sr != sampling_rate:
-            resampler = Resample(orig_freq=sr, new_freq=sampling_rate)
-            audio = resampler(audio)
-        return audio
-
-    def encode_audio(codec_model, audio_prompt, device, target_bw=0.5):
-        if len(audio_prompt.shape) < 3:
-            audio_prompt.unsqueeze_(0)
-        with torch.no_grad():
-            raw_codes = codec_model.encode(audio_prompt.to(device), target_bw=target_bw)
-        raw_codes = raw_codes.transpose(0, 1)
-        raw_codes = raw_codes.cpu().numpy().astype(np.int16)
-        return raw_codes
-
-    def split_lyrics(lyrics):
-        pattern = r"\[(\w+)\](.*?)(?=\[|\Z)"
-        segments = re.findall(pattern, lyrics, re.DOTALL)
-        structured_lyrics = [f"[{seg[0]}]\n{seg[1].strip()}\n\n" for seg in segments]
-        return structured_lyrics
-
-    # Call the function and print the result
-    stage1_output_set = []
-    # Tips:
-    # genre tags support instrumental，genre，mood，vocal timbr and vocal gender
-    # all kinds of tags are needed
-    if args.genre_txt.endswith(".txt"):
-        with open(args.genre_txt, "r", encoding="utf-8") as f:
-            genres = f.read().strip()
-    else:
-        genres = args.genre_txt
+    def __init__(self, args, warmup=True):
+        load_dependencies()
+        self.key = self.resident_key(args)
+        self.cuda_idx = args.cuda_idx
 
-    if args.lyrics_txt.endswith(".txt"):
-        with open(args.lyrics_txt, "r", encoding="utf-8") as f:
-            lyrics = split_lyrics(f.read())
-    else:
-        lyrics = split_lyrics(args.lyrics_txt)
-
-    # intruction
-    full_lyrics = "\n".join(lyrics)
-    prompt_texts = [
-        f"Generate music from the given lyrics segment by segment.\n[Genre] {genres}\n{full_lyrics}"
-    ]
-    prompt_texts += lyrics
-
-    random_id = uuid.uuid4()
-    output_seq = None
-    # Here is suggested decoding config
-    top_p = 0.93
-    temperature = 1.0
-    repetition_penalty = 1.0
-    # special tokens
-    start_of_segment = mmtokenizer.tokenize("[start_of_segment]")
-    end_of_segment = mmtokenizer.tokenize("[end_of_segment]")
-    # Format text prompt
-    run_n_segments = min(args.run_n_segments + 1, len(lyrics))
-    raw_output = None
-    for i, p in enumerate(tqdm(prompt_texts[:run_n_segments], desc="Stage1 inference...")):
-        section_text = p.replace("[start_of_segment]", "").replace(
-            "[end_of_segment]", ""
+        # load tokenizer and model
+        self.device = torch.device(
+            f"cuda:{args.cuda_idx}" if torch.cuda.is_available() else "cpu"
         )
-        guidance_scale = 1.5 if i <= 1 else 1.2
-        if i == 0:
-            continue
-        if i == 1:
-            if args.use_dual_tracks_prompt or args.use_audio_prompt:
-                if args.use_dual_tracks_prompt:
-                    vocals_ids = load_audio_mono(args.vocal_track_prompt_path)
-                    instrumental_ids = load_audio_mono(
-                        args.instrumental_track_prompt_path
-                    )
-                    vocals_ids = encode_audio(
-                        codec_model, vocals_ids, device, target_bw=0.5
-                    )
-                    instrumental_ids = encode_audio(
-                        codec_model, instrumental_ids, device, target_bw=0.5
-                    )
-                    vocals_ids = codectool.npy2ids(vocals_ids[0])
-                    instrumental_ids = codectool.npy2ids(instrumental_ids[0])
-                    ids_segment_interleaved = rearrange(
-                        [np.array(vocals_ids), np.array(instrumental_ids)],
-                        "b n -> (n b)",
-                    )
-                    audio_prompt_codec = ids_segment_interleaved[
-                        int(args.prompt_start_time * 50 * 2) : int(
-                            args.prompt_end_time * 50 * 2
-                        )
-                    ]
-                    audio_prompt_codec = audio_prompt_codec.tolist()
-                elif args.use_audio_prompt:
-                    audio_prompt = load_audio_mono(args.audio_prompt_path)
-                    raw_codes = encode_audio(
-                        codec_model, audio_prompt, device, target_bw=0.5
-                    )
-                    # Format audio prompt
-                    code_ids = codectool.npy2ids(raw_codes[0])
-                    audio_prompt_codec = code_ids[
-                        int(args.prompt_start_time * 50) : int(
-                            args.prompt_end_time * 50
-                        )
-                    ]  # 50 is tps of xcodec
-                audio_prompt_codec_ids = (
-                    [mmtokenizer.soa]
-                    + codectool.sep_ids
-                    + audio_prompt_codec
-                    + [mmtokenizer.eoa]
-                )
-                sentence_ids = (
-                    mmtokenizer.tokenize("[start_of_reference]")
-                    + audio_prompt_codec_ids
-                    + mmtokenizer.tokenize("[end_of_reference]")
-                )
-                head_id = mmtokenizer.tokenize(prompt_texts[0]) + sentence_ids
-            else:
-                head_id = mmtokenizer.tokenize(prompt_texts[0])
-            prompt_ids = (
-                head_id
-                + start_of_segment
-                + mmtokenizer.tokenize(section_text)
-                + [mmtokenizer.soa]
-                + codectool.sep_ids
-            )
-        else:
-            prompt_ids = (
-                end_of_segment
-                + start_of_segment
-                + mmtokenizer.tokenize(section_text)
-                + [mmtokenizer.soa]
-                + codectool.sep_ids
-            )
-
-        prompt_ids = torch.as_tensor(prompt_ids).unsqueeze(0).to(device)
-        input_ids = torch.cat([raw_output, prompt_ids], dim=1) if i > 1 else prompt_ids
-        # Use window slicing in case output sequence exceeds the context of model
-        max_context = 16384 - max_new_tokens - 1
-        if input_ids.shape[-1] > max_context:
-            print(
-                f"Section {i}: output length {input_ids.shape[-1]} exceeding context length {max_context}, now using the last {max_context} tokens."
-            )
-            input_ids = input_ids[:, -(max_context):]
-        with torch.no_grad():
-            output_seq = model.generate(
-                input_ids=input_ids,
-                max_new_tokens=max_new_tokens,
-                min_new_tokens=100,
-                do_sample=True,
-                top_p=top_p,
-                temperature=temperature,
-                repetition_penalty=repetition_penalty,
-                eos_token_id=mmtokenizer.eoa,
-                pad_token_id=mmtokenizer.eoa,
-                logits_processor=LogitsProcessorList(
-                    [
-                        BlockTokenRangeProcessor(0, 32002),
-                        BlockTokenRangeProcessor(32016, 32016),
-                    ]
-                ),
-                guidance_scale=guidance_scale,
-            )
-            if output_seq[0][-1].item() != mmtokenizer.eoa:
-                tensor_eoa = torch.as_tensor([[mmtokenizer.eoa]]).to(model.device)
-                output_seq = torch.cat((output_seq, tensor_eoa), dim=1)
-            if i > 1 or raw_output is not None:
-                raw_output = torch.cat(
-                    [raw_output, prompt_ids, output_seq[:, input_ids.shape[-1] :]], dim=1
-                )
-            else:
-                raw_output = output_seq
-
-    # save raw output and check sanity
-    ids = raw_output[0].cpu().numpy()
-    soa_idx = np.where(ids == mmtokenizer.soa)[0].tolist()
-    eoa_idx = np.where(ids == mmtokenizer.eoa)[0].tolist()
-    if len(soa_idx) != len(eoa_idx):
-        raise ValueError(
-            f"invalid pairs of soa and eoa, Num of soa: {len(soa_idx)}, Num of eoa: {len(eoa_idx)}"
+        print(self.device)
+        self.mmtokenizer = _MMSentencePieceTokenizer(
+            (Path(current_dir) / "mm_tokenizer_v0.2_hf" / "tokenizer.model").as_posix()
         )
 
-    vocals = []
-    instrumentals = []
-    range_begin = 1 if args.use_audio_prompt or args.use_dual_tracks_prompt else 0
-    for i in range(range_begin, len(soa_idx)):
-        codec_ids = ids[soa_idx[i] + 1 : eoa_idx[i]]
-        if codec_ids[0] == 32016:
-            codec_ids = codec_ids[1:]
-        codec_ids = codec_ids[: 2 * (codec_ids.shape[0] // 2)]
-        vocals_ids = codectool.ids2npy(rearrange(codec_ids, "(n b) -> b n", b=2)[0])
-        vocals.append(vocals_ids)
-        instrumentals_ids = codectool.ids2npy(
-            rearrange(codec_ids, "(n b) -> b n", b=2)[1]
-        )
-        instrumentals.append(instrumentals_ids)
-    vocals = np.concatenate(vocals, axis=1)
-    instrumentals = np.concatenate(instrumentals, axis=1)
-    vocal_save_path = os.path.join(
-        stage1_output_dir,
-        f"{genres.replace(' ', '-')}_tp{top_p}_T{temperature}_rp{repetition_penalty}_maxtk{max_new_tokens}_{random_id}_vtrack".replace(
-            ".", "@"
-        )
-        + ".npy",
-    )
-    inst_save_path = os.path.join(
-        stage1_output_dir,
-        f"{genres.replace(' ', '-')}_tp{top_p}_T{temperature}_rp{repetition_penalty}_maxtk{max_new_tokens}_{random_id}_itrack".replace(
-            ".", "@"
+        # flash-attn does not run on the static cache of the compiled decode step
+        quantization = "int8" if args.stage1_model.endswith("int8") else "bf16"
+        attn_implementation = "sdpa" if args.compile else "flash_attention_2"
+        self.model = load_model(
+            args.stage1_model, quantization, attn_implementation=attn_implementation
         )
-        + ".npy",
-    )
-    np.save(vocal_save_path, vocals)
-    np.save(inst_save_path, instrumentals)
-    stage1_output_set.append(vocal_save_path)
-    stage1_output_set.append(inst_save_path)
-
-    # offload model
-    # if not args.disable_offload_model:
-    #     model.cpu()
-    #     del model
-    #     torch.cuda.empty_cache()
-
-    print("Stage 2 inference...")
-    # model_stage2 = AutoModelForCausalLM.from_pretrained(
-    #     stage2_model,
-    #     torch_dtype=torch.float16,
-    #     attn_implementation="flash_attention_2"
-    #     )
-    # model_stage2.to(device)
-    # model_stage2.eval()
-
-    # if torch.__version__ >= "2.0.0":
-    #     model_stage2 = torch.compile(model_stage2)
-
-    def stage2_generate(model, prompt, batch_size=16):
-        codec_ids = codectool.unflatten(prompt, n_quantizer=1)
-        codec_ids = codectool.offset_tok_ids(
-            codec_ids,
-            global_offset=codectool.global_offset,
-            codebook_size=codectool.codebook_size,
-            num_codebooks=codectool.num_codebooks,
-        ).astype(np.int32)
-
-        # Prepare prompt_ids based on batch size or single input
-        if batch_size > 1:
-            codec_list = []
-            for i in range(batch_size):
-                idx_begin = i * 300
-                idx_end = (i + 1) * 300
-                codec_list.append(codec_ids[:, idx_begin:idx_end])
-
-            codec_ids = np.concatenate(codec_list, axis=0)
-            prompt_ids = np.concatenate(
-                [
-                    np.tile([mmtokenizer.soa, mmtokenizer.stage_1], (batch_size, 1)),
-                    codec_ids,
-                    np.tile([mmtokenizer.stage_2], (batch_size, 1)),
-                ],
-                axis=1,
-            )
-        else:
-            prompt_ids = np.concatenate(
-                [
-                    np.array([mmtokenizer.soa, mmtokenizer.stage_1]),
-                    codec_ids.flatten(),  # Flatten the 2D array to 1D
-                    np.array([mmtokenizer.stage_2]),
-                ]
-            ).astype(np.int32)
-            prompt_ids = prompt_ids[np.newaxis, ...]
-
-        codec_ids = torch.as_tensor(codec_ids).to(device)
-        prompt_ids = torch.as_tensor(prompt_ids).to(device)
-        len_prompt = prompt_ids.shape[-1]
-
-        block_list = LogitsProcessorList(
+        # the prefix cache key: besides the weights, the prefilled KV values
+        # depend on their quantization (mmgp's for profiles 3 to 5) and on the
+        # attention kernel
+        self.stage1_cache_name = "|".join(
             [
-                BlockTokenRangeProcessor(0, 46358),
-                BlockTokenRangeProcessor(53526, mmtokenizer.vocab_size),
+                args.stage1_model,
+                quantization,
+                "mmgp qint8" if args.profile in (3, 4, 5) else "not requantized",
+                attn_implementation,
             ]
         )
 
-        # Teacher forcing generate loop
-        for frames_idx in range(codec_ids.shape[1]):
-            cb0 = codec_ids[:, frames_idx : frames_idx + 1]
-            prompt_ids = torch.cat([prompt_ids, cb0], dim=1)
-            input_ids = prompt_ids
-
-            with torch.no_grad():
-                stage2_output = model.generate(
-                    input_ids=input_ids,
-                    min_new_tokens=7,
-                    max_new_tokens=7,
-                    eos_token_id=mmtokenizer.eoa,
-                    pad_token_id=mmtokenizer.eoa,
-                    logits_processor=block_list,
-                )
+        # to device, if gpu is available
+        self.model.eval()
+        self.prefix_cache = PrefixCache(
+            int(args.prefix_cache_ram_gb * 2**30),
+            os.path.join(args.cache_dir, "prefix"),
+            int(args.prefix_cache_disk_gb * 2**30),
+        )
 
-            assert (
-                stage2_output.shape[1] - prompt_ids.shape[1] == 7
-            ), f"output new tokens={stage2_output.shape[1]-prompt_ids.shape[1]}"
-            prompt_ids = stage2_output
+        self.stage2_cache = None
+        if args.stage2_cache_gb > 0:
+            self.stage2_cache = ChunkCache(
+                os.path.join(args.cache_dir, "stage2"),
+                args.stage2_model,
+                int(args.stage2_cache_gb * 2**30),
+            )
 
-        # Return output based on batch size
-        if batch_size > 1:
-            output = prompt_ids.cpu().numpy()[:, len_prompt:]
-            output_list = [output[i] for i in range(batch_size)]
-            output = np.concatenate(output_list, axis=0)
-        else:
-            output = prompt_ids[0].cpu().numpy()[len_prompt:]
+        # The draft stays on the GPU outside of the mmgp pipe: mmgp keeps one
+        # pipe model on the GPU, so a draft in the pipe would swap the stage 1
+        # model out and back in on every speculation round.
+        self.draft_model = None
+        if args.draft_model:
+            self.draft_model = load_model(args.draft_model, "bf16")
+            self.draft_model.to(self.device)
+            self.draft_model.eval()
+
+        # kept with the engine so that later requests reuse its cache and graph
+        self.static_decoder = None
+        if args.compile:
+            self.static_decoder = StaticDecoder(self.model)
+
+        # with --stage2_devices the pool processes load their own copies
+        self.model_stage2 = None
+        if not args.stage2_devices:
+            self.model_stage2 = AutoModelForCausalLM.from_pretrained(
+                args.stage2_model,
+                torch_dtype=torch.bfloat16,
+                attn_implementation="flash_attention_2",
+                # device_map="auto",
+            )
+            self.model_stage2.to("cpu")
+            self.model_stage2.eval()
+
+        pipe = {"transformer": self.model}
+        if self.model_stage2 is not None:
+            pipe["stage2"] = self.model_stage2
+        # mmgp keeps one pipe model on the GPU and unloads the others when a
+        # different one is called, from whichever thread; a stage holds this
+        # for all its model calls so that the other never swaps it out
+        self.pipe_lock = threading.Lock()
+
+        # keep in sync with stage1_cache_name
+        quantizeTransformer = args.profile == 3 or args.profile == 4 or args.profile == 5
+
+        self.codectool = CodecManipulator("xcodec", 0, 1)
+        self.codectool_stage2 = CodecManipulator("xcodec", 0, 8)
+        self.stage2_pool = None
+        if args.stage2_devices:
+            self.stage2_pool = Stage2Pool(
+                args.stage2_model,
+                args.stage2_devices.split(","),
+                self.stage2_decoder_config(),
+            )
+        self.codec_model = load_codec_model(
+            args.basic_model_config, args.resume_path, self.device, args.cache_dir
+        )
 
-        return output
+        print("profile:" + str(args.profile))
 
-    def stage2_inference(model, stage1_output_set, stage2_output_dir, batch_size=4):
-        stage2_result = []
-        for i in tqdm(range(len(stage1_output_set))):
-            output_filename = os.path.join(
-                stage2_output_dir, os.path.basename(stage1_output_set[i])
+        offload.profile(
+            pipe,
+            profile_no=args.profile,
+            quantizeTransformer=quantizeTransformer,
+            compile=False,
+            verboseLevel=1,
+        )
+
+        # vocoder to upsample audios
+        self.vocal_decoder = VocosDecoder.from_hparams(config_path=args.config_path)
+        self.inst_decoder = VocosDecoder.from_hparams(config_path=args.config_path)
+        for decoder, decoder_path in (
+            (self.vocal_decoder, args.vocal_decoder_path),
+            (self.inst_decoder, args.inst_decoder_path),
+        ):
+            decoder.to(self.device)
+            checkpoint_cache.load_state_dict(
+                decoder, decoder_path, cache_dir=args.cache_dir
             )
+            decoder.eval()
+
+        if warmup:
+            self.warmup()
+
+    @classmethod
+    def resident_key(cls, args):
+        return tuple(getattr(args, name, None) for name in cls.resident_args)
+
+    def matches(self, args):
+        return self.resident_key(args) == self.key
+
+    def close(self):
+        """Stop the stage 2 worker processes; the engine cannot be used after."""
+        if self.stage2_pool is not None:
+            self.stage2_pool.close()
+            self.stage2_pool = None
+
+    def warmup(self):
+        """Run one tiny forward pass through every model so that lazy weight
+        transfers and kernel selection happen before the first request."""
+        print("Warming up models...")
+        codec_ids = torch.as_tensor(
+            [[self.mmtokenizer.soa] + self.codectool.sep_ids], device=self.device
+        )
+        with torch.no_grad():
+            self.model(input_ids=codec_ids)
+            if self.model_stage2 is not None:
+                self.model_stage2(input_ids=codec_ids)
+            codes = torch.zeros((8, 1, 50), dtype=torch.long, device=self.device)
+            self.codec_model.decode(codes)
+            embed = self.codec_model.get_embed(codes)
+            self.vocal_decoder(embed)
+            self.inst_decoder(embed)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize(self.device)
+
+    def generate(self, args):
+        """Generate one song for ``args`` (as produced by ``create_args``) and
+        return the path of the final mixed audio, or a list of paths if
+        ``args.num_variations`` asks for several takes."""
+        if not self.matches(args):
+            raise ValueError(
+                "Request asks for different models or caches than the ones this engine has loaded, build a new YuEEngine."
+            )
+        stage1_output_sets = self.run_stage1(args)
+        return self.run_variations(args, stage1_output_sets)
+
+    def generate_batch(self, requests):
+        """Generate one song per entry of ``requests`` (a list of args).
+
+        Stage 1 runs on a producer thread, so the 7B model samples song N+1
+        while codec decoding and the vocoder finish song N. Stage 2 waits for
+        the stage 1 model to be done with the GPU (see ``pipe_lock``), unless
+        it runs on a ``--stage2_devices`` pool. Returns
+        the output audio paths in request order. Songs whose stage 1 is done
+        by the time stage 2 is free go through stage 2 together.
+        """
+        for args in requests:
+            if not self.matches(args):
+                raise ValueError(
+                    "Batch requests must use the models and caches this engine has loaded."
+                )
 
-            if os.path.exists(output_filename):
-                print(f"{output_filename} stage2 has done.")
+        stage1_done = queue.Queue(maxsize=1)
+        stop = threading.Event()
+
+        def stage1_worker():
+            try:
+                with self.stream_context():
+                    for args in requests:
+                        if stop.is_set():
+                            return
+                        stage1_output_sets = self.run_stage1(args)
+                        # marks when the codes are written on this stream
+                        event = None
+                        if self.device.type == "cuda":
+                            event = torch.cuda.Event()
+                            event.record()
+                        stage1_done.put((args, stage1_output_sets, event))
+                stage1_done.put(None)
+            except BaseException as e:
+                stage1_done.put(e)
+
+        worker = threading.Thread(target=stage1_worker, daemon=True)
+        worker.start()
+        outputs = []
+        try:
+            with self.stream_context():
+                finished = False
+                while not finished:
+                    items = [stage1_done.get()]
+                    while not stage1_done.empty():
+                        items.append(stage1_done.get())
+                    songs = []
+                    for item in items:
+                        if item is None:
+                            finished = True
+                            break
+                        if isinstance(item, BaseException):
+                            raise item
+                        args, stage1_output_sets, event = item
+                        self.receive_stage1(stage1_output_sets, event)
+                        songs.append((args, stage1_output_sets))
+                    if songs:
+                        outputs.extend(self.run_songs(songs))
+        finally:
+            stop.set()
+            # unblock the worker if it is waiting on a full queue
+            while worker.is_alive():
+                try:
+                    stage1_done.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        return outputs
+
+    def receive_stage1(self, stage1_output_sets, event):
+        """Make the stage 1 codes, written on another CUDA stream until
+        ``event``, safe to use on the current one: its kernels wait for the
+        event, and the allocator does not hand their memory back to the stage
+        1 stream before the kernels queued here are done with it."""
+        if event is None:
+            return
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_event(event)
+        for stage1_output_set in stage1_output_sets:
+            for track in stage1_output_set:
+                track.codes.record_stream(stream)
+
+    def stream_context(self):
+        # Each pipeline stage issues its kernels on its own stream so that
+        # stage 1 and the codec / vocoder work can overlap on the same GPU.
+        if self.device.type == "cuda":
+            return torch.cuda.stream(torch.cuda.Stream(self.device))
+        return nullcontext()
+
+    def run_stage1(self, args, callback=None):
+        stage1_output_dir = os.path.join(args.output_dir, f"stage1")
+        if args.keep_intermediate:
+            os.makedirs(stage1_output_dir, exist_ok=True)
+
+        seed_everything(args.seed)
+
+        with self.pipe_lock:
+            return self.stage1_inference(args, stage1_output_dir, callback)
+
+    def stream_stage1(self, args):
+        """Run stage 1 for ``args`` and yield its events (``Stage1Token`` for
+        every sampled code, ``Stage1SegmentEnd`` at every segment's <EOA>) as
+        they happen. The generator returns the stage 1 output sets, which
+        ``run_variations`` turns into audio. Closing it early stops stage 1
+        at the next sampled token."""
+        events = queue.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def callback(event):
+            if stop.is_set():
+                raise Stage1Cancelled()
+            events.put(event)
+
+        def stage1_worker():
+            try:
+                events.put((done, self.run_stage1(args, callback)))
+            except Stage1Cancelled:
+                pass
+            except BaseException as e:
+                events.put((done, e))
+
+        worker = threading.Thread(target=stage1_worker, daemon=True)
+        worker.start()
+        try:
+            while True:
+                event = events.get()
+                if isinstance(event, tuple) and event[0] is done:
+                    if isinstance(event[1], BaseException):
+                        raise event[1]
+                    return event[1]
+                yield event
+        finally:
+            stop.set()
+
+    def run_variations(self, args, stage1_output_sets):
+        return self.run_songs([(args, stage1_output_sets)])[0]
+
+    def run_songs(self, songs):
+        """Stage 2 and reconstruction of (args, stage1_output_sets) pairs. The
+        stage 2 chunks of all songs and variations are batched together.
+        Returns the output of every song, a list if it has variations."""
+        jobs = []
+        for args, stage1_output_sets in songs:
+            if len(stage1_output_sets) == 1:
+                jobs.append((args, stage1_output_sets[0]))
                 continue
+            for n, stage1_output_set in enumerate(stage1_output_sets):
+                variation_args = copy.copy(args)
+                variation_args.output_dir = os.path.join(args.output_dir, f"variation_{n}")
+                jobs.append((variation_args, stage1_output_set))
+
+        stage2_jobs = []
+        for args, stage1_output_set in jobs:
+            stage2_output_dir = None
+            if args.keep_intermediate:
+                stage2_output_dir = os.path.join(args.output_dir, f"stage2")
+                os.makedirs(stage2_output_dir, exist_ok=True)
+            stage2_jobs.append((stage1_output_set, stage2_output_dir))
+
+        print("Stage 2 inference...")
+        # the stage 2 pool has its own models, outside of the mmgp pipe
+        with self.pipe_lock if self.stage2_pool is None else nullcontext():
+            stage2_results = self.stage2_inference_jobs(
+                stage2_jobs,
+                batch_size=min(args.stage2_batch_size for args, _ in jobs),
+            )
+        print([[track.name for track in result] for result in stage2_results])
+        print("Stage 2 DONE.\n")
 
-            # Load the prompt
-            prompt = np.load(stage1_output_set[i]).astype(np.int32)
+        outputs = self.reconstruct_jobs(
+            [(args, stage2_result) for (args, _), stage2_result in zip(jobs, stage2_results)]
+        )
+        results = []
+        for _, stage1_output_sets in songs:
+            if len(stage1_output_sets) == 1:
+                results.append(outputs.pop(0))
+            else:
+                results.append(outputs[: len(stage1_output_sets)])
+                del outputs[: len(stage1_output_sets)]
+        return results
+
+    def stage1_inference(self, args, stage1_output_dir, callback=None):
+        model = self.model
+        mmtokenizer = self.mmtokenizer
+        codectool = self.codectool
+        codec_model = self.codec_model
+        device = self.device
+        max_new_tokens = args.max_new_tokens
+        num_variations = args.num_variations
+
+        # Tips:
+        # genre tags support instrumental，genre，mood，vocal timbr and vocal gender
+        # all kinds of tags are needed
+        if args.genre_txt.endswith(".txt"):
+            with open(args.genre_txt, "r", encoding="utf-8") as f:
+                genres = f.read().strip()
+        else:
+            genres = args.genre_txt
 
-            # Only accept 6s segments
-            output_duration = prompt.shape[-1] // 50 // 6 * 6
-            num_batch = output_duration // 6
+        if args.lyrics_txt.endswith(".txt"):
+            with open(args.lyrics_txt, "r", encoding="utf-8") as f:
+                lyrics = split_lyrics(f.read())
+        else:
+            lyrics = split_lyrics(args.lyrics_txt)
 
-            if num_batch <= batch_size:
-                # If num_batch is less than or equal to batch_size, we can infer the entire prompt at once
-                output = stage2_generate(
-                    model, prompt[:, : output_duration * 50], batch_size=num_batch
+        # intruction
+        full_lyrics = "\n".join(lyrics)
+        prompt_texts = [
+            f"Generate music from the given lyrics segment by segment.\n[Genre] {genres}\n{full_lyrics}"
+        ]
+        prompt_texts += lyrics
+
+        random_id = uuid.uuid4()
+        # Here is suggested decoding config
+        top_p = 0.93
+        temperature = 1.0
+        repetition_penalty = 1.0
+        # special tokens
+        start_of_segment = mmtokenizer.tokenize("[start_of_segment]")
+        end_of_segment = mmtokenizer.tokenize("[end_of_segment]")
+        # Format text prompt
+        run_n_segments = min(args.run_n_segments + 1, len(lyrics))
+        # token limit of every segment, from its lyrics
+        budgets = plan_budgets(
+            prompt_texts[1:run_n_segments], max_new_tokens, args.budget_margin
+        )
+        # the prompts of the segments after the first, tokenized once for the
+        # planned context length and for the loop below
+        segment_prompt_ids = {
+            i: end_of_segment
+            + start_of_segment
+            + mmtokenizer.tokenize(
+                p.replace("[start_of_segment]", "").replace("[end_of_segment]", "")
+            )
+            + [mmtokenizer.soa]
+            + codectool.sep_ids
+            for i, p in enumerate(prompt_texts[:run_n_segments])
+            if i >= 2
+        }
+        actual_tokens = []
+        raw_outputs = [None] * num_variations
+        # The tokens the model sees and their KV cache, one per variation,
+        # carried across segments so that only each new segment prompt has to
+        # be prefilled. raw_outputs keep the whole songs for parsing below.
+        contexts = []
+        sampler_kwargs = dict(
+            eos_token_id=mmtokenizer.eoa,
+            top_p=top_p,
+            temperature=temperature,
+            repetition_penalty=repetition_penalty,
+            grammar=InterleavedCodecGrammar(
+                code_range=(
+                    codectool.global_offset,
+                    codectool.global_offset + codectool.codebook_size,
+                ),
+                eos_token_id=mmtokenizer.eoa,
+            ),
+        )
+        if self.draft_model is not None:
+            sampler = SpeculativeStage1Sampler(
+                model,
+                self.draft_model,
+                num_draft_tokens=args.num_draft_tokens,
+                **sampler_kwargs,
+            )
+        else:
+            sampler = Stage1Sampler(
+                model, static_decoder=self.static_decoder, **sampler_kwargs
+            )
+        streamer = None
+        if callback is not None:
+            streamer = Stage1Streamer(
+                callback, codectool.global_offset, mmtokenizer.eoa
+            )
+        for i, p in enumerate(
+            tqdm(prompt_texts[:run_n_segments], desc="Stage1 inference...")
+        ):
+            guidance_scale = 1.5 if i <= 1 else 1.2
+            if i == 0:
+                continue
+            if i == 1:
+                if args.use_dual_tracks_prompt or args.use_audio_prompt:
+                    if args.use_dual_tracks_prompt:
+                        vocals_ids = load_prompt_codes(
+                            codec_model, args.vocal_track_prompt_path, device, args
+                        )
+                        instrumental_ids = load_prompt_codes(
+                            codec_model, args.instrumental_track_prompt_path, device, args
+                        )
+                        vocals_ids = codectool.npy2ids(vocals_ids[0])
+                        instrumental_ids = codectool.npy2ids(instrumental_ids[0])
+                        ids_segment_interleaved = rearrange(
+                            [np.array(vocals_ids), np.array(instrumental_ids)],
+                            "b n -> (n b)",
+                        )
+                        audio_prompt_codec = ids_segment_interleaved[
+                            int(args.prompt_start_time * 50 * 2) : int(
+                                args.prompt_end_time * 50 * 2
+                            )
+                        ]
+                        audio_prompt_codec = audio_prompt_codec.tolist()
+                    elif args.use_audio_prompt:
+                        raw_codes = load_prompt_codes(
+                            codec_model, args.audio_prompt_path, device, args
+                        )
+                        # Format audio prompt
+                        code_ids = codectool.npy2ids(raw_codes[0])
+                        audio_prompt_codec = code_ids[
+                            int(args.prompt_start_time * 50) : int(
+                                args.prompt_end_time * 50
+                            )
+                        ]  # 50 is tps of xcodec
+                    audio_prompt_codec_ids = (
+                        [mmtokenizer.soa]
+                        + codectool.sep_ids
+                        + audio_prompt_codec
+                        + [mmtokenizer.eoa]
+                    )
+                    sentence_ids = (
+                        mmtokenizer.tokenize("[start_of_reference]")
+                        + audio_prompt_codec_ids
+                        + mmtokenizer.tokenize("[end_of_reference]")
+                    )
+                    head_id = mmtokenizer.tokenize(prompt_texts[0]) + sentence_ids
+                else:
+                    head_id = mmtokenizer.tokenize(prompt_texts[0])
+                section_text = p.replace("[start_of_segment]", "").replace(
+                    "[end_of_segment]", ""
+                )
+                prompt_ids = (
+                    head_id
+                    + start_of_segment
+                    + mmtokenizer.tokenize(section_text)
+                    + [mmtokenizer.soa]
+                    + codectool.sep_ids
                 )
             else:
-                # If num_batch is greater than batch_size, process in chunks of batch_size
-                segments = []
-                num_segments = (num_batch // batch_size) + (
-                    1 if num_batch % batch_size != 0 else 0
+                prompt_ids = segment_prompt_ids[i]
+
+            prompt_ids = torch.as_tensor(prompt_ids).unsqueeze(0).to(device)
+            segment_max_new_tokens = budgets[i - 1].max_new_tokens
+            if i == 1:
+                context = SegmentContext(rotary_inv_freq(model))
+                context.add_segment(prompt_ids, len(head_id), head_len=len(head_id))
+                contexts = [context]
+                # the context length the whole song needs, as planned (a
+                # segment cut at its limit gets an <EOA> appended); only the
+                # static cache of --compile is preallocated to it, the
+                # default DynamicCache grows as tokens come
+                planned_length = (
+                    prompt_ids.shape[-1]
+                    + sum(b.max_new_tokens + 1 for b in budgets)
+                    + sum(len(ids) for ids in segment_prompt_ids.values())
                 )
-
-                for seg in range(num_segments):
-                    start_idx = seg * batch_size * 300
-                    # Ensure the end_idx does not exceed the available length
-                    end_idx = min(
-                        (seg + 1) * batch_size * 300, output_duration * 50
-                    )  # Adjust the last segment
-                    current_batch_size = (
-                        batch_size
-                        if seg != num_segments - 1 or num_batch % batch_size == 0
-                        else num_batch % batch_size
+                context.capacity = min(planned_length, stage1_context_length)
+            else:
+                for context in contexts:
+                    context.add_segment(prompt_ids, len(end_of_segment))
+            # Evict whole old segments (never the head prompt) in case the
+            # output sequence exceeds the context of model
+            max_context = stage1_context_length - segment_max_new_tokens - 1
+            for context in contexts:
+                context_len = len(context)
+                if context_len > max_context:
+                    evicted = context.compact(max_context)
+                    print(
+                        f"Section {i}: output length {context_len} exceeding context length {max_context}, evicted {evicted} old segments, now using {len(context)} tokens."
                     )
-                    segment = stage2_generate(
-                        model,
-                        prompt[:, start_idx:end_idx],
-                        batch_size=current_batch_size,
+            if i == 1:
+                # The head does not depend on the seed or the sampling
+                # settings: reuse its prefill from earlier runs if possible.
+                # It is prefilled once, every variation samples from a fork.
+                prefix_ids = context.ids[:, :-1]
+                past_key_values = self.prefix_cache.get(
+                    self.stage1_cache_name, prefix_ids, device
+                )
+                if past_key_values is not None:
+                    context.past_key_values = past_key_values
+                    print(f"Reusing the prefilled prompt ({prefix_ids.shape[-1]} tokens).")
+                else:
+                    sampler.prefill(context)
+                    self.prefix_cache.put(
+                        self.stage1_cache_name, prefix_ids, context.past_key_values
                     )
-                    segments.append(segment)
+                contexts += [context.fork() for _ in range(num_variations - 1)]
+            if streamer is not None:
+                streamer.start_segment(i - 1, num_variations)
+            new_ids_list, past_key_values_list = sampler.sample_batch(
+                contexts,
+                guidance_scale=guidance_scale,
+                max_new_tokens=segment_max_new_tokens,
+                min_new_tokens=100,
+                on_token=None if streamer is None else streamer.on_token,
+            )
+            actual_tokens.append([new_ids.shape[-1] for new_ids in new_ids_list])
+            if streamer is not None:
+                streamer.end_segment()
+            for n, (context, new_ids, past_key_values) in enumerate(
+                zip(contexts, new_ids_list, past_key_values_list)
+            ):
+                if new_ids[0][-1].item() != mmtokenizer.eoa:
+                    tensor_eoa = torch.as_tensor([[mmtokenizer.eoa]]).to(device)
+                    new_ids = torch.cat((new_ids, tensor_eoa), dim=1)
+                context.update(torch.cat([context.ids, new_ids], dim=1), past_key_values)
+                if raw_outputs[n] is not None:
+                    raw_outputs[n] = torch.cat([raw_outputs[n], prompt_ids, new_ids], dim=1)
+                else:
+                    raw_outputs[n] = torch.cat([prompt_ids, new_ids], dim=1)
+
+        print(f"Planned stage 1 context: {contexts[0].capacity} tokens.")
+        print(budget_report(budgets, actual_tokens))
+        if self.draft_model is not None:
+            print(sampler.report())
+
+        stage1_output_sets = []
+        for n, raw_output in enumerate(raw_outputs):
+            name = f"{genres.replace(' ', '-')}_tp{top_p}_T{temperature}_rp{repetition_penalty}_maxtk{max_new_tokens}_{random_id}"
+            if num_variations > 1:
+                name += f"_v{n}"
+            stage1_output_sets.append(
+                self.save_stage1_output(args, raw_output, stage1_output_dir, name)
+            )
+        return stage1_output_sets
+
+    def save_stage1_output(self, args, raw_output, stage1_output_dir, name):
+        """Split the sampled ids into the codebook 0 codes of the vocal and
+        the instrumental track, as TrackCodes on the device. They are only
+        written to ``stage1_output_dir`` with --keep_intermediate."""
+        mmtokenizer = self.mmtokenizer
+        codectool = self.codectool
+
+        # check sanity
+        ids = raw_output[0]
+        soa_idx = torch.nonzero(ids == mmtokenizer.soa)[:, 0].tolist()
+        eoa_idx = torch.nonzero(ids == mmtokenizer.eoa)[:, 0].tolist()
+        if len(soa_idx) != len(eoa_idx):
+            raise ValueError(
+                f"invalid pairs of soa and eoa, Num of soa: {len(soa_idx)}, Num of eoa: {len(eoa_idx)}"
+            )
 
-                # Concatenate all the segments
-                output = np.concatenate(segments, axis=0)
+        vocals = []
+        instrumentals = []
+        range_begin = 1 if args.use_audio_prompt or args.use_dual_tracks_prompt else 0
+        for i in range(range_begin, len(soa_idx)):
+            codec_ids = ids[soa_idx[i] + 1 : eoa_idx[i]]
+            if codec_ids[0].item() == 32016:
+                codec_ids = codec_ids[1:]
+            codec_ids = codec_ids[: 2 * (codec_ids.shape[0] // 2)]
+            # interleaved vocal, instrumental, vocal, ... codebook 0 ids
+            vocals.append(codec_ids[0::2] - codectool.global_offset)
+            instrumentals.append(codec_ids[1::2] - codectool.global_offset)
+        tracks = []
+        for suffix, codes in (("vtrack", vocals), ("itrack", instrumentals)):
+            track_name = f"{name}_{suffix}".replace(".", "@")
+            codes = torch.cat(codes)[None]
+            path = None
+            if args.keep_intermediate:
+                path = os.path.join(stage1_output_dir, track_name + ".npy")
+                np.save(path, codes.cpu().numpy())
+            tracks.append(TrackCodes(track_name, codes, path))
+        return tracks
+
+    def stage2_decoder_config(self):
+        """The Stage2Decoder arguments besides the model."""
+        mmtokenizer = self.mmtokenizer
+        codectool = self.codectool
+        # the k-th token after each codebook 0 token is a code of codebook k
+        code_ranges = [
+            (
+                codectool.global_offset + k * codectool.codebook_size,
+                codectool.global_offset + (k + 1) * codectool.codebook_size,
+            )
+            for k in range(1, 8)
+        ]
+        return dict(
+            code_ranges=code_ranges,
+            prompt_head=(mmtokenizer.soa, mmtokenizer.stage_1),
+            prompt_tail=(mmtokenizer.stage_2,),
+            code_offset=codectool.global_offset,
+        )
 
-            # Process the ending part of the prompt
-            if output_duration * 50 != prompt.shape[-1]:
-                ending = stage2_generate(
-                    model, prompt[:, output_duration * 50 :], batch_size=1
-                )
-                output = np.concatenate([output, ending], axis=0)
-            output = codectool_stage2.ids2npy(output)
-
-            # Fix invalid codes (a dirty solution, which may harm the quality of audio)
-            # We are trying to find better one
-            fixed_output = copy.deepcopy(output)
-            for i, line in enumerate(output):
-                for j, element in enumerate(line):
-                    if element < 0 or element > 1023:
-                        counter = Counter(line)
-                        most_frequant = sorted(
-                            counter.items(), key=lambda x: x[1], reverse=True
-                        )[0][0]
-                        fixed_output[i, j] = most_frequant
-            # save output
-            np.save(output_filename, fixed_output)
-            stage2_result.append(output_filename)
-        return stage2_result
+    def stage2_generate(self, chunks):
+        decoder = Stage2Decoder(self.model_stage2, **self.stage2_decoder_config())
+        return decoder.generate_chunks(chunks, self.device)
+
+    def stage2_inference(self, stage1_output_set, stage2_output_dir, batch_size=4):
+        return self.stage2_inference_jobs(
+            [(stage1_output_set, stage2_output_dir)], batch_size
+        )[0]
+
+    def stage2_inference_jobs(self, jobs, batch_size=4):
+        """Stage 2 for several (stage1_output_set, stage2_output_dir) jobs at
+        once: the 6 second chunks and the tails of all their tracks are
+        batched together. Returns the TrackCodes of every job; they are only
+        written to ``stage2_output_dir`` if it is not None."""
+        codectool = self.codectool_stage2
+        stage2_result = [[] for _ in jobs]
+        tracks = []
+        chunks = []
+        for job, (stage1_output_set, stage2_output_dir) in enumerate(jobs):
+            for stage1_output in stage1_output_set:
+                output_filename = None
+                if stage2_output_dir is not None:
+                    output_filename = os.path.join(
+                        stage2_output_dir, stage1_output.name + ".npy"
+                    )
+                    if os.path.exists(output_filename):
+                        print(f"{output_filename} stage2 has done.")
+                        codes = torch.as_tensor(np.load(output_filename)).to(self.device)
+                        stage2_result[job].append(
+                            TrackCodes(stage1_output.name, codes, output_filename)
+                        )
+                        continue
 
-    stage2_result = stage2_inference(
-        model_stage2,
-        stage1_output_set,
-        stage2_output_dir,
-        batch_size=args.stage2_batch_size,
-    )
-    print(stage2_result)
-    print("Stage 2 DONE.\n")
-
-    # convert audio tokens to audio
-    def save_audio(wav: torch.Tensor, path, sample_rate: int, rescale: bool = False):
-        folder_path = os.path.dirname(path)
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
-        limit = 0.99
-        max_val = wav.abs().max()
-        wav = wav * min(limit / max_val, 1) if rescale else wav.clamp(-limit, limit)
-        torchaudio.save(
-            str(path),
-            wav,
-            sample_rate=sample_rate,
-            encoding="PCM_S",
-            bits_per_sample=16,
+                chunks.extend(split_chunks(len(tracks), stage1_output.codes[0]))
+                tracks.append(
+                    (job, len(stage2_result[job]), stage1_output.name, output_filename)
+                )
+                stage2_result[job].append(None)
+
+        outputs = run_chunks(
+            chunks,
+            batch_size,
+            self.stage2_generate,
+            tqdm,
+            self.stage2_cache,
+            None if self.stage2_pool is None else self.stage2_pool.imap,
         )
+        offsets = codectool.global_offset + codectool.codebook_size * torch.arange(
+            codectool.n_quantizer, device=self.device
+        )
+        for track, (job, slot, name, output_filename) in enumerate(tracks):
+            # (T * 8,) ids to (8, T) codes; every code lies in its own
+            # codebook, see stage2_generate
+            codes = outputs[track].view(-1, codectool.n_quantizer).T - offsets[:, None]
+            if output_filename is not None:
+                np.save(output_filename, codes.cpu().numpy())
+            stage2_result[job][slot] = TrackCodes(name, codes, output_filename)
+        return stage2_result
 
-    # reconstruct tracks
-    recons_output_dir = os.path.join(args.output_dir, "recons")
-    recons_mix_dir = os.path.join(recons_output_dir, "mix")
-    os.makedirs(recons_mix_dir, exist_ok=True)
-    tracks = []
-    for npy in stage2_result:
-        codec_result = np.load(npy)
-        decodec_rlt = []
+    def vocode(self, codes, output_file, rescale, decoder):
+        """Upsample the (n_q, T) ``codes`` of a track to 44.1kHz with a vocos
+        ``decoder``, as the xcodec ``process_audio`` does for .npy files."""
+        with torch.no_grad():
+            embed = self.codec_model.get_embed(codes.long().unsqueeze(1).to(self.device))
+            start_time = time.time()
+            out = decoder(embed).detach().cpu()
+        duration = time.time() - start_time
+        print(f"Decoded in {duration:.2f}s ({out.shape[-1] / 44100.0 / duration:.2f}x RTF)")
+        save_audio(out, output_file, 44100, rescale=rescale)
+        print(f"Saved: {output_file}")
+        return out
+
+    def reconstruct(self, args, stage2_result):
+        return self.reconstruct_jobs([(args, stage2_result)])[0]
+
+    def reconstruct_jobs(self, jobs):
+        """Codec decode, vocoder and mixing of several (args, stage2_result)
+        jobs. The xcodec decode of every track of every job is batched, see
+        ``decode_batch``, and the vocal and instrumental vocoders run at the
+        same time on their own threads. Returns the output audio of every job."""
+        codec_model = self.codec_model
+        device = self.device
+
+        # reconstruct tracks
         with torch.no_grad():
-            decoded_waveform = codec_model.decode(
-                torch.as_tensor(codec_result.astype(np.int16), dtype=torch.long)
-                .unsqueeze(0)
-                .permute(1, 0, 2)
-                .to(device)
+            waveforms = decode_batch(
+                codec_model.decode,
+                [
+                    track.codes.long().to(device)
+                    for _, stage2_result in jobs
+                    for track in stage2_result
+                ],
+                codec_model.hop_length,
+                batch_size=min(args.codec_batch_size for args, _ in jobs),
+                window_frames=min(args.codec_window_frames for args, _ in jobs),
             )
-        decoded_waveform = decoded_waveform.cpu().squeeze(0)
-        decodec_rlt.append(torch.as_tensor(decoded_waveform, device="cpu"))
-        decodec_rlt = torch.cat(decodec_rlt, dim=-1)
-        save_path = os.path.join(
-            recons_output_dir, os.path.splitext(os.path.basename(npy))[0] + ".mp3"
-        )
-        tracks.append(save_path)
-        save_audio(decodec_rlt, save_path, 16000)
-    # mix tracks
-    for inst_path in tracks:
-        try:
-            if (
-                inst_path.endswith(".wav") or inst_path.endswith(".mp3")
-            ) and "_itrack" in inst_path:
-                # find pair
-                vocal_path = inst_path.replace("_itrack", "_vtrack")
-                if not os.path.exists(vocal_path):
-                    continue
-                # mix
-                recons_mix = os.path.join(
-                    recons_mix_dir,
-                    os.path.basename(inst_path).replace("_itrack", "_mixed"),
+        waveforms = iter(waveforms)
+        recons_mixes = []
+        for args, stage2_result in jobs:
+            recons_output_dir = os.path.join(args.output_dir, "recons")
+            recons_mix_dir = os.path.join(recons_output_dir, "mix")
+            os.makedirs(recons_mix_dir, exist_ok=True)
+            tracks = []
+            for track in stage2_result:
+                decoded_waveform = next(waveforms).cpu()
+                save_path = os.path.join(recons_output_dir, track.name + ".mp3")
+                tracks.append(save_path)
+                save_audio(decoded_waveform, save_path, 16000)
+            # mix tracks
+            recons_mix = None
+            for inst_path in tracks:
+                try:
+                    if (
+                        inst_path.endswith(".wav") or inst_path.endswith(".mp3")
+                    ) and "_itrack" in inst_path:
+                        # find pair
+                        vocal_path = inst_path.replace("_itrack", "_vtrack")
+                        if not os.path.exists(vocal_path):
+                            continue
+                        # mix
+                        recons_mix = os.path.join(
+                            recons_mix_dir,
+                            os.path.basename(inst_path).replace("_itrack", "_mixed"),
+                        )
+                        vocal_stem, sr = sf.read(inst_path)
+                        instrumental_stem, _ = sf.read(vocal_path)
+                        mix_stem = (vocal_stem + instrumental_stem) / 1
+                        sf.write(recons_mix, mix_stem, sr)
+                except Exception as e:
+                    print(e)
+            if recons_mix is None:
+                raise RuntimeError(f"No vocal and instrumental pair to mix in {recons_output_dir}")
+            recons_mixes.append(recons_mix)
+
+        # one thread per vocoder, each with the stems of every job
+        vocoder_tracks = {"itrack": [], "vtrack": []}
+        for job, (args, stage2_result) in enumerate(jobs):
+            vocoder_stems_dir = os.path.join(args.output_dir, "vocoder", "stems")
+            os.makedirs(vocoder_stems_dir, exist_ok=True)
+            for track in stage2_result:
+                stem = "itrack" if "_itrack" in track.name else "vtrack"
+                output_file = os.path.join(vocoder_stems_dir, stem + ".mp3")
+                vocoder_tracks[stem].append((job, track.codes, output_file, args.rescale))
+        vocoder_outputs = {}
+
+        def run_vocoder(stem, decoder):
+            with self.stream_context():
+                for job, codes, output_file, rescale in vocoder_tracks[stem]:
+                    vocoder_outputs[job, stem] = self.vocode(codes, output_file, rescale, decoder)
+
+        if device.type == "cuda":
+            # the codes come from other streams
+            torch.cuda.synchronize(device)
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [
+                pool.submit(run_vocoder, "itrack", self.inst_decoder),
+                pool.submit(run_vocoder, "vtrack", self.vocal_decoder),
+            ]
+            for future in futures:
+                future.result()
+
+        outputs = []
+        for job, ((args, _), recons_mix) in enumerate(zip(jobs, recons_mixes)):
+            vocoder_mix_dir = os.path.join(args.output_dir, "vocoder", "mix")
+            os.makedirs(vocoder_mix_dir, exist_ok=True)
+            instrumental_output = vocoder_outputs[job, "itrack"]
+            vocal_output = vocoder_outputs[job, "vtrack"]
+            # mix tracks
+            try:
+                mix_output = instrumental_output + vocal_output
+                vocoder_mix = os.path.join(vocoder_mix_dir, os.path.basename(recons_mix))
+                save_audio(mix_output, vocoder_mix, 44100, args.rescale)
+                print(f"Created mix: {vocoder_mix}")
+            except RuntimeError as e:
+                print(e)
+                print(
+                    f"mix {vocoder_mix} failed! inst: {instrumental_output.shape}, vocal: {vocal_output.shape}"
                 )
-                vocal_stem, sr = sf.read(inst_path)
-                instrumental_stem, _ = sf.read(vocal_path)
-                mix_stem = (vocal_stem + instrumental_stem) / 1
-                sf.write(recons_mix, mix_stem, sr)
-        except Exception as e:
-            print(e)
-
-    # vocoder to upsample audios
-    vocal_decoder, inst_decoder = build_codec_model(
-        args.config_path, args.vocal_decoder_path, args.inst_decoder_path
-    )
-    vocoder_output_dir = os.path.join(args.output_dir, "vocoder")
-    vocoder_stems_dir = os.path.join(vocoder_output_dir, "stems")
-    vocoder_mix_dir = os.path.join(vocoder_output_dir, "mix")
-    os.makedirs(vocoder_mix_dir, exist_ok=True)
-    os.makedirs(vocoder_stems_dir, exist_ok=True)
-    for npy in stage2_result:
-        if "_itrack" in npy:
-            # Process instrumental
-            instrumental_output = process_audio(
-                npy,
-                os.path.join(vocoder_stems_dir, "itrack.mp3"),
-                args.rescale,
-                args,
-                inst_decoder,
-                codec_model,
-            )
-        else:
-            # Process vocal
-            vocal_output = process_audio(
-                npy,
-                os.path.join(vocoder_stems_dir, "vtrack.mp3"),
-                args.rescale,
-                args,
-                vocal_decoder,
-                codec_model,
+
+            # Post process
+            replace_low_freq_with_energy_matched(
+                a_file=recons_mix,  # 16kHz
+                b_file=vocoder_mix,  # 48kHz
+                c_file=os.path.join(args.output_dir, os.path.basename(recons_mix)),
+                cutoff_freq=5500.0,
             )
-    # mix tracks
-    try:
-        mix_output = instrumental_output + vocal_output
-        vocoder_mix = os.path.join(vocoder_mix_dir, os.path.basename(recons_mix))
-        save_audio(mix_output, vocoder_mix, 44100, args.rescale)
-        print(f"Created mix: {vocoder_mix}")
-    except RuntimeError as e:
-        print(e)
-        print(
-            f"mix {vocoder_mix} failed! inst: {instrumental_output.shape}, vocal: {vocal_output.shape}"
-        )
 
-    # Post process
-    replace_low_freq_with_energy_matched(
-        a_file=recons_mix,  # 16kHz
-        b_file=vocoder_mix,  # 48kHz
-        c_file=os.path.join(args.output_dir, os.path.basename(recons_mix)),
-        cutoff_freq=5500.0,
-    )
+            outputs.append(os.path.join(args.output_dir, os.path.basename(recons_mix)))
+        return outputs
+
 
-    output_audio = os.path.join(args.output_dir, os.path.basename(recons_mix))
+# Short request field names accepted in --batch_jsonl files, in addition to
+# the plain argument names of create_args.
+request_fields = {
+    "genre": "genre_txt",
+    "lyrics": "lyrics_txt",
+    "segments": "run_n_segments",
+}
 
-    return output_audio
+
+def load_requests(path, base_args):
+    """Read a JSONL file of song requests into a list of args.
+
+    Every request starts from ``base_args`` and overrides the fields it sets.
+    Each song is written to its own sub directory of ``base_args.output_dir``,
+    named after the request's ``id`` or its line number.
+    """
+    requests = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            args = copy.copy(base_args)
+            song_id = str(request.pop("id", f"{len(requests):04d}"))
+            for key, value in request.items():
+                name = request_fields.get(key, key)
+                if not hasattr(base_args, name):
+                    raise ValueError(f"Unknown field '{key}' in request {song_id}")
+                setattr(args, name, value)
+            if request.get("audio_prompt_path"):
+                args.use_audio_prompt = True
+            if request.get("vocal_track_prompt_path") and request.get(
+                "instrumental_track_prompt_path"
+            ):
+                args.use_dual_tracks_prompt = True
+            if args.genre_txt is None or args.lyrics_txt is None:
+                raise ValueError(f"Request {song_id} needs a genre and lyrics.")
+            args.output_dir = os.path.join(base_args.output_dir, song_id)
+            requests.append(args)
+    return requests
+
+
+def main(args, engine=None):
+    if engine is not None:
+        return engine.generate(args)
+    engine = YuEEngine(args)
+    try:
+        return engine.generate(args)
+    finally:
+        engine.close()
 
 
 if __name__ == "__main__":
@@ -921,4 +1469,15 @@ if __name__ == "__main__":
             "Please offer audio prompt filepath using '--audio_prompt_path', when you enable 'use_audio_prompt'!"
         )
 
-    main(args)
+    if args.batch_jsonl:
+        requests = load_requests(args.batch_jsonl, args)
+        engine = YuEEngine(args)
+        try:
+            for output_audio in engine.generate_batch(requests):
+                print(output_audio)
+        finally:
+            engine.close()
+    else:
+        if args.genre_txt is None or args.lyrics_txt is None:
+            parser.error("--genre_txt and --lyrics_txt are required without --batch_jsonl")
+        main(args)
@@ -0,0 +1,98 @@
+"""KV caches of prefilled stage 1 prompts, reused across requests.
+
+The head of the stage 1 prompt (instruction, genre, lyrics, reference audio
+and the first segment's header) does not depend on the seed or the sampling
+settings, so runs that only change those prefill exactly the same tokens.
+``PrefixCache`` keeps the prefilled KV state keyed by the model and the
+token ids. The model name given to it must tell apart everything that
+changes the KV values: weights, quantization and attention kernel. Entries
+live in host RAM in least recently used order; the ones that do not fit the
+RAM budget are spilled as safetensors files to ``cache_dir``, which is
+itself trimmed to its own byte budget by last use.
+"""
+
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+from safetensors.torch import load_file, save_file
+
+from cache_files import trim_folder, write_atomic
+from stage1_context import cache_from_layers, cache_layers
+
+
+def layers_nbytes(layers):
+    return sum(
+        k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layers
+    )
+
+
+class PrefixCache:
+    def __init__(self, max_ram_bytes, cache_dir=None, max_disk_bytes=0):
+        self.max_ram_bytes = max_ram_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes if cache_dir else 0
+        # key -> [[keys, values], ...] on the CPU, least recently used first
+        self.entries = OrderedDict()
+        self.ram_bytes = 0
+
+    @staticmethod
+    def key(model_name, ids):
+        digest = hashlib.sha256(model_name.encode("utf-8") + b"\0")
+        digest.update(ids.cpu().numpy().astype(np.int64).tobytes())
+        return digest.hexdigest()
+
+    def disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.safetensors")
+
+    def get(self, model_name, ids, device):
+        """The cache of ``model_name`` prefilled with ``ids`` (1, T), on
+        ``device``, or None."""
+        key = self.key(model_name, ids)
+        layers = self.entries.get(key)
+        if layers is not None:
+            self.entries.move_to_end(key)
+        elif self.max_disk_bytes and os.path.exists(self.disk_path(key)):
+            path = self.disk_path(key)
+            tensors = load_file(path)
+            layers = [
+                [tensors[f"{i}.keys"], tensors[f"{i}.values"]]
+                for i in range(len(tensors) // 2)
+            ]
+            os.utime(path)
+            self.add(key, layers)
+        else:
+            return None
+        return cache_from_layers([[k.to(device), v.to(device)] for k, v in layers])
+
+    def put(self, model_name, ids, past_key_values):
+        """Remember ``past_key_values``, the cache of ``model_name`` prefilled
+        with ``ids`` (1, T)."""
+        key = self.key(model_name, ids)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        self.add(key, [[k.cpu(), v.cpu()] for k, v in cache_layers(past_key_values)])
+
+    def add(self, key, layers):
+        self.entries[key] = layers
+        self.ram_bytes += layers_nbytes(layers)
+        while self.ram_bytes > self.max_ram_bytes and self.entries:
+            old_key, old_layers = self.entries.popitem(last=False)
+            self.ram_bytes -= layers_nbytes(old_layers)
+            self.spill(old_key, old_layers)
+
+    def spill(self, key, layers):
+        if not self.max_disk_bytes or layers_nbytes(layers) > self.max_disk_bytes:
+            return
+        path = self.disk_path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tensors = {}
+        for i, (k, v) in enumerate(layers):
+            tensors[f"{i}.keys"] = k.contiguous()
+            tensors[f"{i}.values"] = v.contiguous()
+        write_atomic(path, lambda tmp_path: save_file(tensors, tmp_path))
+        trim_folder(self.cache_dir, ".safetensors", self.max_disk_bytes)
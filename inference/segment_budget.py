@@ -0,0 +1,84 @@
+"""Per segment token budgets for stage 1.
+
+Stage 1 used to give every segment the same ``max_new_tokens`` and to keep
+that worst case free in the context window. A segment's length mostly follows
+its lyrics, so ``plan_budgets`` estimates the tokens of each segment from its
+section type and the amount of text sung in it, and, given a safety margin,
+caps the segment at the estimate times the margin (never above
+``max_new_tokens``). The estimates are deliberately generous: the cap is
+there to stop runaway segments, not to shorten normal ones. The pace
+constants below are not calibrated on real songs yet, so the cap is off
+unless a margin is given (``--budget_margin``).
+"""
+
+import re
+from collections import namedtuple
+
+# 50 xcodec frames per second, vocal and instrumental codes interleaved
+tokens_per_second = 100
+# singing pace, with the pause at the end of every line
+words_per_second = 1.5
+cjk_chars_per_second = 3.0
+line_seconds = 1.0
+# the length of sections without lyrics, by section type
+instrumental_seconds = {
+    "intro": 15,
+    "outro": 15,
+    "inst": 20,
+    "instrumental": 20,
+    "solo": 20,
+    "interlude": 15,
+    "break": 10,
+}
+default_instrumental_seconds = 15
+# no segment is capped below this
+min_budget_tokens = 500
+
+SegmentBudget = namedtuple("SegmentBudget", "section estimate max_new_tokens")
+
+cjk_char = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]")
+
+
+def section_type(segment):
+    match = re.match(r"\s*\[(\w+)\]", segment)
+    return match.group(1).lower() if match else ""
+
+
+def estimate_tokens(segment):
+    """Expected number of stage 1 tokens of a ``split_lyrics`` segment."""
+    lines = [line for line in segment.strip().splitlines()[1:] if line.strip()]
+    seconds = 0.0
+    for line in lines:
+        cjk_chars = len(cjk_char.findall(line))
+        words = len(cjk_char.sub(" ", line).split())
+        seconds += words / words_per_second + cjk_chars / cjk_chars_per_second + line_seconds
+    if not lines:
+        seconds = instrumental_seconds.get(section_type(segment), default_instrumental_seconds)
+    return int(seconds * tokens_per_second)
+
+
+def plan_budgets(segments, max_new_tokens, margin=None):
+    """A SegmentBudget per segment. Without a ``margin`` (None or <= 0) the
+    planner only estimates, and every segment gets ``max_new_tokens``."""
+    budgets = []
+    for segment in segments:
+        estimate = estimate_tokens(segment)
+        limit = max_new_tokens
+        if margin is not None and margin > 0:
+            limit = min(max_new_tokens, max(int(estimate * margin), min_budget_tokens))
+        budgets.append(SegmentBudget(section_type(segment), estimate, limit))
+    return budgets
+
+
+def budget_report(budgets, actual):
+    """A table of the estimated, allowed and ``actual`` tokens of every
+    segment; ``actual`` holds a list of counts (one per variation) per segment."""
+    lines = ["Stage 1 segment budgets (estimated / limit / actual tokens):"]
+    for i, (budget, counts) in enumerate(zip(budgets, actual)):
+        hit = " (limit reached)" if any(c >= budget.max_new_tokens for c in counts) else ""
+        lines.append(
+            f"  {i}: [{budget.section}] {budget.estimate} / {budget.max_new_tokens} / "
+            + ", ".join(str(c) for c in counts)
+            + hit
+        )
+    return "\n".join(lines)
@@ -0,0 +1,146 @@
+import torch
+from transformers import DynamicCache
+
+
+def rotate_half(x):
+    x1, x2 = x.chunk(2, dim=-1)
+    return torch.cat((-x2, x1), dim=-1)
+
+
+def shift_rotary(keys, shift, inv_freq):
+    """Move rotary embedded ``keys`` (B, H, T, D) by ``shift`` positions."""
+    freqs = shift * inv_freq.to(device=keys.device, dtype=torch.float32)
+    emb = torch.cat((freqs, freqs), dim=-1)
+    k = keys.float()
+    return (k * emb.cos() + rotate_half(k) * emb.sin()).to(keys.dtype)
+
+
+def rotary_inv_freq(model):
+    for module in model.modules():
+        inv_freq = getattr(module, "inv_freq", None)
+        if isinstance(inv_freq, torch.Tensor):
+            return inv_freq
+    raise ValueError(f"{model.__class__.__name__} has no rotary embedding")
+
+
+def cache_layers(cache):
+    """[keys, values] of every layer of a DynamicCache, as mutable pairs."""
+    if hasattr(cache, "layers"):  # transformers >= 4.54 keeps one object per layer
+        return [[layer.keys, layer.values] for layer in cache.layers]
+    return [[k, v] for k, v in zip(cache.key_cache, cache.value_cache)]
+
+
+def set_cache_layers(cache, layers):
+    if hasattr(cache, "layers"):
+        for layer, (keys, values) in zip(cache.layers, layers):
+            layer.keys, layer.values = keys, values
+    else:
+        for i, (keys, values) in enumerate(layers):
+            cache.key_cache[i], cache.value_cache[i] = keys, values
+        if hasattr(cache, "_seen_tokens"):
+            cache._seen_tokens = layers[0][0].shape[-2]
+
+
+def cache_from_layers(layers):
+    cache = DynamicCache()
+    for layer_idx, (keys, values) in enumerate(layers):
+        cache.update(keys, values, layer_idx)
+    return cache
+
+
+def evict_cache_span(cache, start, end, inv_freq):
+    """Drop positions [start, end) from ``cache`` in place.
+
+    Keys after the span are rotated back by ``end - start`` positions, to the
+    positions a fresh prefill of the shortened sequence would assign. Only
+    layer 0 then equals such a prefill: the keys and values of deeper layers
+    were computed attending to the evicted tokens, so, as with StreamingLLM
+    style eviction, the cache is an approximation of the shortened context.
+    """
+    layers = cache_layers(cache)
+    for pair in layers:
+        keys, values = pair
+        tail_keys = shift_rotary(keys[:, :, end:], start - end, inv_freq)
+        pair[0] = torch.cat([keys[:, :, :start], tail_keys], dim=2)
+        pair[1] = torch.cat([values[:, :, :start], values[:, :, end:]], dim=2)
+    set_cache_layers(cache, layers)
+
+
+class SegmentContext:
+    """The token context stage 1 feeds to the model, with its KV cache.
+
+    The context is a head prompt (instruction, genre, full lyrics and the
+    optional reference audio) followed by whole lyric segments. When it grows
+    past the model's window, the oldest segments are evicted from both the
+    tokens and the KV cache, so the head is never cut and nothing has to be
+    prefilled again (at the price of the approximation explained in
+    ``evict_cache_span``).
+    """
+
+    def __init__(self, inv_freq):
+        self.inv_freq = inv_freq
+        # the length the context is planned to reach, which the static cache
+        # of stage1_static is preallocated to
+        self.capacity = None
+        self.ids = None
+        self.head_len = 0
+        # position of the first token of every segment still in the context
+        self.segment_starts = []
+        self.past_key_values = None
+
+    def __len__(self):
+        return 0 if self.ids is None else self.ids.shape[-1]
+
+    def add_segment(self, prompt_ids, segment_offset, head_len=0):
+        """Append the prompt of a new segment, which starts ``segment_offset``
+        tokens into ``prompt_ids``. The first call also carries the head."""
+        if self.ids is None:
+            self.head_len = head_len
+            self.ids = prompt_ids
+        else:
+            self.ids = torch.cat([self.ids, prompt_ids], dim=1)
+        self.segment_starts.append(len(self) - prompt_ids.shape[-1] + segment_offset)
+
+    def update(self, output_seq, past_key_values):
+        self.ids = output_seq
+        self.past_key_values = past_key_values
+
+    def fork(self):
+        """A copy that can grow independently. The KV cache tensors are shared,
+        which is safe as they are only ever replaced, never written to."""
+        fork = SegmentContext(self.inv_freq)
+        fork.capacity = self.capacity
+        fork.ids = self.ids
+        fork.head_len = self.head_len
+        fork.segment_starts = list(self.segment_starts)
+        if self.past_key_values is not None:
+            fork.past_key_values = cache_from_layers(cache_layers(self.past_key_values))
+        return fork
+
+    def compact(self, max_len):
+        """Evict the oldest segments until the context fits in ``max_len``
+        tokens. Returns the number of evicted segments. The head and the
+        newest segment are always kept; if they alone do not fit, fall back
+        to keeping the last ``max_len`` tokens and drop the KV cache."""
+        evicted = 0
+        while len(self) > max_len and len(self.segment_starts) > 1:
+            self.evict(self.segment_starts[0], self.segment_starts[1])
+            evicted += 1
+        if len(self) > max_len:
+            cut = len(self) - max_len
+            self.ids = self.ids[:, cut:]
+            self.head_len = max(self.head_len - cut, 0)
+            self.segment_starts = [s - cut for s in self.segment_starts if s >= cut]
+            self.past_key_values = None
+        return evicted
+
+    def evict(self, start, end):
+        self.ids = torch.cat([self.ids[:, :start], self.ids[:, end:]], dim=1)
+        self.segment_starts = [
+            s - (end - start) for s in self.segment_starts if s >= end
+        ]
+        if self.past_key_values is not None:
+            if end > self.past_key_values.get_seq_length():
+                self.past_key_values = None
+            else:
+                evict_cache_span(self.past_key_values, start, end, self.inv_freq)
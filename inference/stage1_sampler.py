@@ -0,0 +1,336 @@
+import inspect
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+from stage1_context import cache_from_layers, cache_layers
+
+
+def logits_to_keep_arg(model):
+    """The forward argument asking the model for the logits of the last
+    positions only, so that prefilling a long prompt does not materialise
+    (T, vocab) logits. None for models without one."""
+    params = inspect.signature(type(model).forward).parameters
+    for name in ("logits_to_keep", "num_logits_to_keep"):
+        if name in params:
+            return name
+    return None
+
+
+def top_k_filter(scores, top_k):
+    # same as transformers' TopKLogitsWarper
+    top_k = min(top_k, scores.size(-1))
+    indices_to_remove = scores < torch.topk(scores, top_k)[0][..., -1, None]
+    return scores.masked_fill(indices_to_remove, -float("inf"))
+
+
+def top_p_filter(scores, top_p, min_tokens_to_keep=1):
+    # same as transformers' TopPLogitsWarper
+    sorted_logits, sorted_indices = torch.sort(scores, descending=False)
+    cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+    sorted_indices_to_remove = cumulative_probs <= (1 - top_p)
+    sorted_indices_to_remove[..., -min_tokens_to_keep:] = 0
+    indices_to_remove = sorted_indices_to_remove.scatter(
+        1, sorted_indices, sorted_indices_to_remove
+    )
+    return scores.masked_fill(indices_to_remove, -float("inf"))
+
+
+def stack_caches(caches, masks=None):
+    """One cache holding the rows of all ``caches``, the shorter ones left
+    padded, and its attention mask. ``masks`` are the attention masks of the
+    caches' rows, None for a cache without padding."""
+    layers = [cache_layers(cache) for cache in caches]
+    lengths = [row_layers[0][0].shape[-2] for row_layers in layers]
+    total = max(lengths)
+    if masks is None:
+        masks = [None] * len(caches)
+
+    stacked = []
+    for layer_idx in range(len(layers[0])):
+        keys, values = [], []
+        for row_layers, length in zip(layers, lengths):
+            k, v = row_layers[layer_idx]
+            keys.append(F.pad(k, (0, 0, total - length, 0)))
+            values.append(F.pad(v, (0, 0, total - length, 0)))
+        stacked.append((torch.cat(keys), torch.cat(values)))
+
+    mask_rows = []
+    for row_layers, length, mask in zip(layers, lengths, masks):
+        keys = row_layers[0][0]
+        if mask is None:
+            mask = torch.ones((keys.shape[0], length), dtype=torch.long, device=keys.device)
+        mask_rows.append(F.pad(mask, (total - length, 0)))
+    return cache_from_layers(stacked), torch.cat(mask_rows)
+
+
+def split_rows(cache, mask):
+    """One cache per row of ``cache``, keeping only the positions ``mask``
+    marks as attended."""
+    layers = cache_layers(cache)
+    caches = []
+    for row, row_mask in enumerate(mask.bool()):
+        caches.append(
+            cache_from_layers(
+                [[k[row : row + 1, :, row_mask], v[row : row + 1, :, row_mask]] for k, v in layers]
+            )
+        )
+    return caches
+
+
+class InterleavedCodecGrammar:
+    """What stage 1 may sample inside an audio segment.
+
+    The parser in ``stage1_inference`` reads a segment as xcodec codebook 0
+    tokens alternating vocal / instrumental, closed by ``<EOA>``. Every token
+    is therefore restricted to the codebook 0 range, and ``<EOA>`` is only
+    allowed after a complete vocal / instrumental pair (and after
+    ``min_new_tokens``). Both states are a precomputed additive bias, built
+    once per vocabulary size and device.
+    """
+
+    def __init__(self, code_range, eos_token_id):
+        self.code_range = code_range
+        self.eos_token_id = eos_token_id
+        self.biases = {}
+
+    def get_biases(self, vocab_size, device):
+        key = (vocab_size, device)
+        if key not in self.biases:
+            codes_only = torch.full((vocab_size,), -float("inf"), device=device)
+            codes_only[self.code_range[0] : self.code_range[1]] = 0
+            codes_or_eos = codes_only.clone()
+            codes_or_eos[self.eos_token_id] = 0
+            self.biases[key] = (codes_only, codes_or_eos)
+        return self.biases[key]
+
+    def bias(self, scores, n_new, min_new_tokens):
+        """The bias for the ``n_new``-th new token, to add to ``scores``."""
+        codes_only, codes_or_eos = self.get_biases(scores.shape[-1], scores.device)
+        if n_new >= min_new_tokens and n_new % 2 == 0:
+            return codes_or_eos
+        return codes_only
+
+
+class Stage1Sampler:
+    """Top-k / top-p sampling for stage 1 with batched classifier-free guidance.
+
+    transformers' ``guidance_scale`` runs the unconditional branch as a second,
+    unbatched forward pass on every step. Here the conditional and the
+    unconditional sequence are stacked into one batch of two, each row with
+    its own (left padded) part of the KV cache, and their logits are mixed
+    the same way ``UnbatchedClassifierFreeGuidanceLogitsProcessor`` does. The
+    unconditional context starts, as in transformers, from the last prompt
+    token only.
+    """
+
+    def __init__(
+        self,
+        model,
+        eos_token_id,
+        top_p=0.93,
+        top_k=50,
+        temperature=1.0,
+        repetition_penalty=1.0,
+        grammar=None,
+        logits_processor=(),
+        static_decoder=None,
+    ):
+        self.model = model
+        self.eos_token_id = eos_token_id
+        self.top_p = top_p
+        # 50 is the top_k transformers' generate applies unless told otherwise
+        self.top_k = top_k
+        self.temperature = temperature
+        self.repetition_penalty = repetition_penalty
+        self.grammar = grammar
+        self.logits_processor = list(logits_processor)
+        # a StaticDecoder to run the decode steps with, if any
+        self.static_decoder = static_decoder
+        self.logits_to_keep = logits_to_keep_arg(model)
+
+    def forward(self, input_ids, past_key_values, **kwargs):
+        logits, past_key_values = self.forward_logits(input_ids, past_key_values, 1, **kwargs)
+        return logits[:, -1], past_key_values
+
+    def forward_logits(self, input_ids, past_key_values, num_logits, **kwargs):
+        """The float logits of the last ``num_logits`` positions, and the cache."""
+        if self.logits_to_keep is not None:
+            kwargs[self.logits_to_keep] = num_logits
+        output = self.model(
+            input_ids=input_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            **kwargs,
+        )
+        return output.logits[:, -num_logits:].float(), output.past_key_values
+
+    def process(self, ids, cond_logits, uncond_logits, guidance_scale, n_new, min_new_tokens):
+        scores = F.log_softmax(cond_logits, dim=-1)
+        if uncond_logits is not None:
+            uncond = F.log_softmax(uncond_logits, dim=-1)
+            scores = guidance_scale * (scores - uncond) + uncond
+        if self.repetition_penalty != 1.0:
+            score = torch.gather(scores, 1, ids)
+            score = torch.where(
+                score < 0, score * self.repetition_penalty, score / self.repetition_penalty
+            )
+            scores = scores.scatter(1, ids, score)
+        if self.grammar is not None:
+            scores = scores + self.grammar.bias(scores, n_new, min_new_tokens)
+        elif n_new < min_new_tokens:
+            scores[:, self.eos_token_id] = -float("inf")
+        for processor in self.logits_processor:
+            scores = processor(ids, scores)
+        if self.temperature != 1.0:
+            scores = scores / self.temperature
+        if self.top_k:
+            scores = top_k_filter(scores, self.top_k)
+        if self.top_p < 1.0:
+            scores = top_p_filter(scores, self.top_p)
+        return scores
+
+    @torch.no_grad()
+    def prefill(self, context):
+        """Fill the KV cache of ``context`` with all its tokens but the last,
+        which sampling feeds to get the logits of the first new token."""
+        past_key_values = context.past_key_values
+        if past_key_values is None:
+            past_key_values = DynamicCache()
+        cached = past_key_values.get_seq_length()
+        if cached < len(context) - 1:
+            _, past_key_values = self.forward(context.ids[:, cached:-1], past_key_values)
+        context.past_key_values = past_key_values
+
+    def sample(self, context, guidance_scale, max_new_tokens, min_new_tokens=0, on_token=None):
+        """Sample one segment after ``context`` (a SegmentContext).
+
+        Returns the new tokens (1, n), ending with eos unless
+        ``max_new_tokens`` was reached, and the KV cache of the conditional
+        sequence covering the context and all new tokens but the last.
+        ``on_token(row, token)`` is called with every token as it is sampled.
+        """
+        new_ids, caches = self.sample_batch(
+            [context], guidance_scale, max_new_tokens, min_new_tokens, on_token
+        )
+        return new_ids[0], caches[0]
+
+    @torch.no_grad()
+    def sample_batch(
+        self, contexts, guidance_scale, max_new_tokens, min_new_tokens=0, on_token=None
+    ):
+        """Sample one segment after each of ``contexts`` as one batch.
+
+        The contexts may differ in length; each row of the batch is left
+        padded and positioned on its own. Rows that reach eos stop attending
+        to what the batch feeds them afterwards. Returns, per context, what
+        ``sample`` returns.
+        """
+        n = len(contexts)
+        device = contexts[0].ids.device
+        for context in contexts:
+            self.prefill(context)
+        past_key_values, attention_mask = stack_caches(
+            [context.past_key_values for context in contexts]
+        )
+        last_ids = torch.cat([context.ids[:, -1:] for context in contexts])
+
+        # the prompts right aligned, padded with their own first token so that
+        # the padding does not change the repetition penalty
+        prompt_len = max(len(context) for context in contexts)
+        ids = torch.empty(
+            (n, prompt_len + max_new_tokens), dtype=last_ids.dtype, device=device
+        )
+        for row, context in enumerate(contexts):
+            pad = prompt_len - len(context)
+            ids[row, :pad] = context.ids[0, 0]
+            ids[row, pad:prompt_len] = context.ids[0]
+        cur_len = prompt_len
+
+        # the position of the next token of a row is the number of tokens it attends to
+        position_ids = attention_mask.sum(-1, keepdim=True)
+        attention_mask = F.pad(attention_mask, (0, 1), value=1)
+        cond_logits, past_key_values = self.forward(
+            last_ids, past_key_values, attention_mask=attention_mask, position_ids=position_ids
+        )
+        use_cfg = guidance_scale is not None and guidance_scale != 1
+        uncond_logits = None
+        if use_cfg:
+            # rows [0, n) are conditional, rows [n, 2n) unconditional
+            uncond_logits, uncond_cache = self.forward(last_ids, DynamicCache())
+            past_key_values, attention_mask = stack_caches(
+                [past_key_values, uncond_cache], [attention_mask, None]
+            )
+        position_ids = attention_mask.sum(-1, keepdim=True)
+        width = attention_mask.shape[1]
+        static_decoder = self.static_decoder
+        if static_decoder is not None:
+            # sized for the whole song if it was planned, so that one cache
+            # (and one compiled graph) serves all segments
+            planned = max(context.capacity or 0 for context in contexts)
+            past_key_values, capacity = static_decoder.load(
+                past_key_values, max(width + max_new_tokens, planned)
+            )
+            attention_mask = F.pad(attention_mask, (0, capacity - width))
+        else:
+            attention_mask = F.pad(attention_mask, (0, max_new_tokens))
+
+        running = torch.ones(n, dtype=torch.bool, device=device)
+        lengths = torch.full((n,), max_new_tokens, device=device)
+        for n_new in range(max_new_tokens):
+            scores = self.process(
+                ids[:, :cur_len], cond_logits, uncond_logits, guidance_scale, n_new, min_new_tokens
+            )
+            probs = F.softmax(scores, dim=-1)
+            next_token = torch.multinomial(probs, num_samples=1)[:, 0]
+            next_token = torch.where(running, next_token, self.eos_token_id)
+            ids[:, cur_len] = next_token
+            if on_token is not None:
+                for row, (token, is_running) in enumerate(
+                    zip(next_token.tolist(), running.tolist())
+                ):
+                    if is_running:
+                        on_token(row, token)
+            cur_len += 1
+            done = running & (next_token == self.eos_token_id)
+            lengths[done] = n_new + 1
+            running &= ~done
+            if n_new + 1 == max_new_tokens or not running.any():
+                break
+            # finished rows keep being fed, but nothing they are fed is attended to
+            step_mask = running.repeat(2) if use_cfg else running
+            attention_mask[:, width] = step_mask
+            width += 1
+            input_ids = next_token[:, None]
+            if use_cfg:
+                input_ids = input_ids.repeat(2, 1)
+            if static_decoder is not None:
+                logits = static_decoder.step(
+                    input_ids,
+                    past_key_values,
+                    attention_mask,
+                    position_ids,
+                    torch.tensor([width - 1], device=device),
+                )
+            else:
+                logits, past_key_values = self.forward(
+                    input_ids,
+                    past_key_values,
+                    attention_mask=attention_mask[:, :width],
+                    position_ids=position_ids,
+                )
+            position_ids = position_ids + step_mask[:, None]
+            if use_cfg:
+                cond_logits, uncond_logits = logits[:n], logits[n:]
+            else:
+                cond_logits = logits
+
+        if static_decoder is not None:
+            past_key_values = static_decoder.unload(width)
+        caches = split_rows(past_key_values, attention_mask[:n, :width])
+        new_ids = [
+            ids[row : row + 1, prompt_len : prompt_len + length]
+            for row, length in enumerate(lengths.tolist())
+        ]
+        return new_ids, caches
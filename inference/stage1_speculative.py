@@ -0,0 +1,206 @@
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+from stage1_context import cache_from_layers, cache_layers
+from stage1_sampler import Stage1Sampler, split_rows, stack_caches
+
+
+class GuidedRows:
+    """The conditional row and, with guidance, the unconditional row of one
+    model, kept as one left padded batch that is fed the same tokens.
+
+    The unconditional row starts empty, so that, as in transformers, it only
+    sees the last prompt token and the tokens sampled after it.
+    """
+
+    def __init__(self, sampler, past_key_values, use_cfg):
+        self.sampler = sampler
+        self.use_cfg = use_cfg
+        caches = [past_key_values]
+        if use_cfg:
+            caches.append(
+                cache_from_layers(
+                    [[k[:, :, :0], v[:, :, :0]] for k, v in cache_layers(past_key_values)]
+                )
+            )
+        self.past_key_values, self.attention_mask = stack_caches(caches)
+
+    def feed(self, input_ids, num_logits):
+        """Append ``input_ids`` (1, m) to every row. Returns the conditional
+        and unconditional (or None) logits of the last ``num_logits``
+        positions, (num_logits, vocab) each."""
+        rows = self.attention_mask.shape[0]
+        m = input_ids.shape[-1]
+        position_ids = self.attention_mask.sum(-1, keepdim=True) + torch.arange(
+            m, device=input_ids.device
+        )
+        self.attention_mask = F.pad(self.attention_mask, (0, m), value=1)
+        logits, self.past_key_values = self.sampler.forward_logits(
+            input_ids.expand(rows, -1),
+            self.past_key_values,
+            num_logits,
+            attention_mask=self.attention_mask,
+            position_ids=position_ids,
+        )
+        return logits[0], logits[1] if self.use_cfg else None
+
+    def drop(self, n):
+        """Forget the last ``n`` fed tokens."""
+        if n:
+            self.past_key_values.crop(-n)
+            self.attention_mask = self.attention_mask[:, :-n]
+
+    def conditional_cache(self):
+        return split_rows(self.past_key_values, self.attention_mask[:1])[0]
+
+
+class SpeculativeStage1Sampler(Stage1Sampler):
+    """Stage1Sampler in which a small draft model proposes the tokens.
+
+    Every round the draft samples up to ``num_draft_tokens`` tokens one by
+    one, then the target model scores all of them in one forward pass. A
+    proposal x is accepted with probability min(1, p(x) / q(x)), where p and
+    q are the target's and the draft's distributions after the same
+    processing (guidance, grammar, top-k, top-p), and the first rejected one
+    is replaced by a sample of max(p - q, 0). The tokens are then distributed
+    exactly as when sampling the target alone, while the target runs one
+    forward pass per round instead of one per token.
+
+    The draft must use the target's vocabulary. It keeps no KV cache between
+    segments: it prefills the whole context at the start of each one, which
+    is cheap for a small model. Several contexts are sampled one after the
+    other. ``stats`` counts the rounds, proposed and accepted draft tokens
+    and sampled tokens since the sampler was made.
+    """
+
+    def __init__(self, model, draft_model, eos_token_id, num_draft_tokens=4, **kwargs):
+        super().__init__(model, eos_token_id, **kwargs)
+        if draft_model.config.vocab_size != model.config.vocab_size:
+            raise ValueError(
+                f"The draft model has {draft_model.config.vocab_size} tokens, the stage 1 model {model.config.vocab_size}; they must share the tokenizer."
+            )
+        self.draft = Stage1Sampler(draft_model, eos_token_id, **kwargs)
+        self.num_draft_tokens = num_draft_tokens
+        self.stats = {"rounds": 0, "proposed": 0, "accepted": 0, "tokens": 0}
+
+    def report(self):
+        stats = self.stats
+        return (
+            f"Speculative decoding: accepted {stats['accepted']}/{stats['proposed']} draft tokens "
+            f"({stats['accepted'] / max(stats['proposed'], 1):.1%}), "
+            f"{stats['tokens'] / max(stats['rounds'], 1):.2f} tokens per stage 1 forward pass."
+        )
+
+    def sample_batch(
+        self, contexts, guidance_scale, max_new_tokens, min_new_tokens=0, on_token=None
+    ):
+        new_ids, caches = [], []
+        for row, context in enumerate(contexts):
+            row_on_token = None
+            if on_token is not None:
+
+                def row_on_token(_, token, row=row):
+                    on_token(row, token)
+
+            ids, cache = self.sample(
+                context, guidance_scale, max_new_tokens, min_new_tokens, row_on_token
+            )
+            new_ids.append(ids)
+            caches.append(cache)
+        return new_ids, caches
+
+    @torch.no_grad()
+    def sample(self, context, guidance_scale, max_new_tokens, min_new_tokens=0, on_token=None):
+        use_cfg = guidance_scale is not None and guidance_scale != 1
+        # both models' caches cover all tokens but the last one, which the
+        # first round feeds
+        self.prefill(context)
+        target = GuidedRows(self, context.past_key_values, use_cfg)
+        _, draft_cache = self.draft.forward(context.ids[:, :-1], DynamicCache())
+        draft = GuidedRows(self.draft, draft_cache, use_cfg)
+        # the number of leading tokens of ids the draft has been fed
+        draft_len = len(context) - 1
+
+        prompt_len = len(context)
+        device = context.ids.device
+        ids = torch.empty(
+            (1, prompt_len + max_new_tokens), dtype=context.ids.dtype, device=device
+        )
+        ids[:, :prompt_len] = context.ids
+        cur_len = prompt_len
+        finished = False
+        while not finished:
+            n_new = cur_len - prompt_len
+            num_draft = min(self.num_draft_tokens, max_new_tokens - n_new - 1)
+
+            # the draft proposes
+            draft_probs = []
+            for j in range(num_draft):
+                cond_logits, uncond_logits = draft.feed(ids[:, draft_len : cur_len + j], 1)
+                draft_len = cur_len + j
+                scores = self.draft.process(
+                    ids[:, : cur_len + j], cond_logits, uncond_logits,
+                    guidance_scale, n_new + j, min_new_tokens,
+                )
+                probs = F.softmax(scores, dim=-1)
+                ids[:, cur_len + j] = torch.multinomial(probs, num_samples=1)[:, 0]
+                draft_probs.append(probs[0])
+                if ids[0, cur_len + j].item() == self.eos_token_id:
+                    break
+            num_draft = len(draft_probs)
+
+            # the target verifies all proposals and samples one more token
+            cond_logits, uncond_logits = target.feed(
+                ids[:, cur_len - 1 : cur_len + num_draft], num_draft + 1
+            )
+            accepted = 0
+            next_token = None
+            for j in range(num_draft + 1):
+                scores = self.process(
+                    ids[:, : cur_len + j],
+                    cond_logits[j : j + 1],
+                    None if uncond_logits is None else uncond_logits[j : j + 1],
+                    guidance_scale, n_new + j, min_new_tokens,
+                )
+                probs = F.softmax(scores, dim=-1)[0]
+                if j == num_draft:
+                    next_token = torch.multinomial(probs, num_samples=1)
+                    break
+                token = ids[0, cur_len + j]
+                if torch.rand((), device=device) * draft_probs[j][token] < probs[token]:
+                    accepted += 1
+                    continue
+                residual = (probs - draft_probs[j]).clamp_min(0)
+                if residual.sum() <= 0:
+                    residual = probs
+                next_token = torch.multinomial(residual / residual.sum(), num_samples=1)
+                break
+
+            stats = self.stats
+            stats["rounds"] += 1
+            stats["proposed"] += num_draft
+            stats["accepted"] += accepted
+            fed = cur_len + num_draft
+            cur_len += accepted
+            if accepted and ids[0, cur_len - 1].item() == self.eos_token_id:
+                finished = True
+            else:
+                ids[:, cur_len] = next_token
+                cur_len += 1
+                finished = (
+                    next_token.item() == self.eos_token_id
+                    or cur_len - prompt_len == max_new_tokens
+                )
+            stats["tokens"] += cur_len - prompt_len - n_new
+            if on_token is not None:
+                for token in ids[0, prompt_len + n_new : cur_len].tolist():
+                    on_token(0, token)
+
+            # forget what was fed after the last accepted token
+            target.drop(fed - (cur_len - 1))
+            kept = min(draft_len, cur_len - 1)
+            draft.drop(draft_len - kept)
+            draft_len = kept
+
+        return ids[:, prompt_len:cur_len], target.conditional_cache()
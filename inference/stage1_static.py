@@ -0,0 +1,85 @@
+import inspect
+
+import torch
+from transformers import StaticCache
+
+from stage1_context import cache_from_layers, cache_layers
+from stage1_sampler import logits_to_keep_arg
+
+
+class StaticDecoder:
+    """Stage 1 decode steps on a statically shaped KV cache, compiled once.
+
+    ``torch.compile`` can only reuse a graph (and CUDA graphs can only be
+    replayed) while every input keeps its shape. The dynamic cache grows by a
+    token each step, so the decode loop instead runs on one preallocated
+    ``StaticCache`` whose length is rounded up to ``bucket`` tokens and which
+    is kept for the following segments and requests. Every step then feeds
+    tensors of the same shapes: the new token of each row, its position, its
+    slot in the cache and the attention mask over the whole cache.
+    """
+
+    def __init__(self, model, bucket=2048, compile=True):
+        self.model = model
+        self.bucket = bucket
+        self.logits_to_keep = logits_to_keep_arg(model)
+        self.cache = None
+        self.rows = None
+        self.capacity = 0
+        self.step = self.forward
+        if compile:
+            self.step = torch.compile(self.forward, mode="reduce-overhead")
+
+    def forward(self, input_ids, past_key_values, attention_mask, position_ids, cache_position):
+        kwargs = {}
+        if self.logits_to_keep is not None:
+            kwargs[self.logits_to_keep] = 1
+        output = self.model(
+            input_ids=input_ids,
+            past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            cache_position=cache_position,
+            use_cache=True,
+            **kwargs,
+        )
+        return output.logits[:, -1].float()
+
+    def new_cache(self, rows, capacity, like):
+        params = inspect.signature(StaticCache.__init__).parameters
+        if "max_batch_size" in params:  # transformers < 4.56 allocates up front
+            return StaticCache(
+                config=self.model.config,
+                max_batch_size=rows,
+                max_cache_len=capacity,
+                device=like.device,
+                dtype=like.dtype,
+            )
+        return StaticCache(config=self.model.config, max_cache_len=capacity)
+
+    def load(self, past_key_values, min_capacity):
+        """Copy a DynamicCache into the static cache, which must hold at least
+        ``min_capacity`` positions. Returns the static cache and its length."""
+        layers = cache_layers(past_key_values)
+        keys = layers[0][0]
+        rows, width = keys.shape[0], keys.shape[-2]
+        if self.cache is None or rows != self.rows or min_capacity > self.capacity:
+            self.cache = None
+            self.rows = rows
+            self.capacity = -(-min_capacity // self.bucket) * self.bucket
+            self.cache = self.new_cache(rows, self.capacity, keys)
+        else:
+            # newer transformers write at their own running offset, not at
+            # cache_position, so a reused cache has to start over
+            self.cache.reset()
+        cache_position = torch.arange(width, device=keys.device)
+        for layer_idx, (k, v) in enumerate(layers):
+            self.cache.update(k, v, layer_idx, {"cache_position": cache_position})
+        return self.cache, self.capacity
+
+    def unload(self, width):
+        """A DynamicCache with the first ``width`` positions of the static
+        cache. It shares the static cache's memory until it is copied."""
+        return cache_from_layers(
+            [[k[:, :, :width], v[:, :, :width]] for k, v in cache_layers(self.cache)]
+        )
@@ -0,0 +1,43 @@
+"""Events stage 1 emits while it samples, for consumers that do not want to
+wait for the whole song (see ``YuEEngine.stream_stage1``)."""
+
+from collections import namedtuple
+
+# A codebook 0 code (0..1023) of the "vocal" or the "instrumental" track of
+# a variation, sent as soon as it is sampled. Segments count from 0.
+Stage1Token = namedtuple("Stage1Token", "variation segment track code")
+
+# Sent at the end of a segment, when <EOA> was sampled or max_new_tokens was
+# reached. ``frames`` is the number of vocal / instrumental code pairs the
+# segment holds once its unpaired last code, if any, is dropped.
+Stage1SegmentEnd = namedtuple("Stage1SegmentEnd", "variation segment frames")
+
+
+class Stage1Streamer:
+    """Turns the tokens the stage 1 sampler reports into events for
+    ``callback``. Within a segment the codes alternate vocal, instrumental,
+    vocal, ..., starting with vocal."""
+
+    tracks = ("vocal", "instrumental")
+
+    def __init__(self, callback, code_offset, eos_token_id):
+        self.callback = callback
+        self.code_offset = code_offset
+        self.eos_token_id = eos_token_id
+        self.segment = None
+        self.counts = []
+
+    def start_segment(self, segment, num_variations):
+        self.segment = segment
+        self.counts = [0] * num_variations
+
+    def on_token(self, row, token):
+        if token == self.eos_token_id:
+            return
+        track = self.tracks[self.counts[row] % 2]
+        self.counts[row] += 1
+        self.callback(Stage1Token(row, self.segment, track, token - self.code_offset))
+
+    def end_segment(self):
+        for row, count in enumerate(self.counts):
+            self.callback(Stage1SegmentEnd(row, self.segment, count // 2))
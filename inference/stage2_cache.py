@@ -0,0 +1,56 @@
+"""Content addressed cache of stage 2 chunks.
+
+Stage 2 decodes greedily, so the output of a 6 second chunk only depends on
+its codebook 0 codes and the stage 2 model. ``ChunkCache`` writes every chunk
+to ``<cache_dir>/stage2/<key>.npy`` as soon as its batch is done, keyed by a
+hash of both. A run that crashed resumes from the chunks it had finished, and
+material that repeats, within a song or across runs, is decoded once. The
+folder is trimmed to its byte budget by last use.
+
+The model is identified by its name or path only: clear the folder when the
+weights behind a name change.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+from cache_files import trim_folder, write_atomic
+
+# part of every key; bump it when the stage 2 decoding changes
+key_version = 1
+
+
+class ChunkCache:
+    def __init__(self, cache_dir, model_name, max_bytes):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+
+    def key(self, codes):
+        """The key of a chunk's (T,) codebook 0 ``codes``."""
+        digest = hashlib.sha256(f"{key_version}\0{self.model_name}\0".encode("utf-8"))
+        digest.update(codes.cpu().numpy().astype(np.int16).tobytes())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def get(self, key, device):
+        """The stage 2 ids of the chunk ``key`` on ``device``, or None."""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        return torch.as_tensor(np.load(path).astype(np.int64)).to(device)
+
+    def put(self, key, ids):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(key)
+        ids = ids.cpu().numpy().astype(np.int32)
+        write_atomic(path, lambda tmp_path: np.save(tmp_path, ids), ".npy")
+
+    def trim(self):
+        trim_folder(self.cache_dir, ".npy", self.max_bytes)
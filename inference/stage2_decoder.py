@@ -0,0 +1,120 @@
+import torch
+import torch.nn.functional as F
+
+from stage1_sampler import logits_to_keep_arg
+
+
+class Stage2Decoder:
+    """Teacher forced stage 2 decoding on one KV cache per batch of chunks.
+
+    Every frame of a chunk starts with its codebook 0 token from stage 1,
+    followed by the 7 residual codebook tokens the model picks greedily. The
+    tokens are fed to the model incrementally: the prompt is prefilled once
+    together with the first frame's codebook 0 token, then every step feeds
+    the token picked last (and, at the start of a frame, the next codebook 0
+    token). A chunk of T frames thus costs T * 8 forward tokens instead of
+    the O(T^2) of re-running the growing prompt for every frame.
+
+    ``code_ranges`` holds the [start, end) ids allowed for each of the 7
+    generated tokens of a frame. Prompts of different lengths are left
+    padded; the frames past the end of a shorter chunk can be filled with any
+    code and dropped, as they cannot change the frames before them.
+
+    A chunk's prompt is ``prompt_head``, its codebook 0 codes offset by
+    ``code_offset``, then ``prompt_tail``.
+    """
+
+    def __init__(self, model, code_ranges, prompt_head=(), prompt_tail=(), code_offset=0):
+        self.model = model
+        self.code_ranges = code_ranges
+        self.prompt_head = list(prompt_head)
+        self.prompt_tail = list(prompt_tail)
+        self.code_offset = code_offset
+        self.logits_to_keep = logits_to_keep_arg(model)
+
+    def step(self, input_ids, past_key_values, attention_mask=None, position_ids=None):
+        kwargs = {}
+        if self.logits_to_keep is not None:
+            kwargs[self.logits_to_keep] = 1
+        output = self.model(
+            input_ids=input_ids,
+            past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
+            **kwargs,
+        )
+        return output.logits[:, -1].float(), output.past_key_values
+
+    @torch.no_grad()
+    def generate(self, prompt_ids, codec_ids, attention_mask=None):
+        """``prompt_ids`` (B, L) and the codebook 0 ids ``codec_ids`` (B, T)
+        of B chunks, with the (B, L) ``attention_mask`` of the prompts if they
+        are left padded. Returns the (B, T * (1 + len(code_ranges))) frames."""
+        num_frames = codec_ids.shape[1]
+        frame_len = 1 + len(self.code_ranges)
+        codec_ids = codec_ids.long()
+        output = torch.empty(
+            (codec_ids.shape[0], num_frames * frame_len),
+            dtype=torch.long,
+            device=codec_ids.device,
+        )
+        output[:, ::frame_len] = codec_ids
+        position_ids = None
+        if attention_mask is not None:
+            attention_mask = F.pad(attention_mask.long(), (0, output.shape[1]), value=1)
+            position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        past_key_values = None
+        fed = 0
+        input_ids = torch.cat([prompt_ids.long(), codec_ids[:, :1]], dim=1)
+        for frame in range(num_frames):
+            offset = frame * frame_len
+            for k, (start, end) in enumerate(self.code_ranges, 1):
+                if attention_mask is None:
+                    logits, past_key_values = self.step(input_ids, past_key_values)
+                else:
+                    width = fed + input_ids.shape[1]
+                    logits, past_key_values = self.step(
+                        input_ids,
+                        past_key_values,
+                        attention_mask[:, :width],
+                        position_ids[:, fed:width],
+                    )
+                fed += input_ids.shape[1]
+                # greedy over the allowed ids; the first maximum wins, as in
+                # an argmax over the whole vocabulary with the rest masked
+                token = logits[:, start:end].argmax(-1) + start
+                output[:, offset + k] = token
+                input_ids = token[:, None]
+            if frame + 1 < num_frames:
+                input_ids = torch.cat([input_ids, codec_ids[:, frame + 1 : frame + 2]], dim=1)
+        return output
+
+    def generate_chunks(self, chunks, device):
+        """Stage 2 for a batch of chunks, each the (T,) codebook 0 codes of up
+        to 300 frames as a tensor. The prompts of chunks shorter than the
+        longest are left padded and their extra frames dropped. Returns the
+        (T * 8,) ids of every chunk, on ``device``."""
+        num_frames = max(len(chunk) for chunk in chunks)
+        prompt_len = len(self.prompt_head) + num_frames + len(self.prompt_tail)
+        prompt_ids = torch.zeros((len(chunks), prompt_len), dtype=torch.long, device=device)
+        attention_mask = torch.zeros_like(prompt_ids)
+        codec_ids = torch.zeros((len(chunks), num_frames), dtype=torch.long, device=device)
+        head = torch.tensor(self.prompt_head, dtype=torch.long, device=device)
+        tail = torch.tensor(self.prompt_tail, dtype=torch.long, device=device)
+        for i, chunk in enumerate(chunks):
+            # codebook 0 ids
+            ids = chunk.to(device).long() + self.code_offset
+            pad = num_frames - len(ids)
+            prompt_ids[i, pad:] = torch.cat([head, ids, tail])
+            attention_mask[i, pad:] = 1
+            codec_ids[i, : len(ids)] = ids
+            codec_ids[i, len(ids) :] = ids[-1]
+
+        output = self.generate(
+            prompt_ids,
+            codec_ids,
+            None if attention_mask.all() else attention_mask,
+        )
+        frame_len = 1 + len(self.code_ranges)
+        return [output[i, : len(chunk) * frame_len] for i, chunk in enumerate(chunks)]
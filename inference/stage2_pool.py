@@ -0,0 +1,187 @@
+"""Data parallel stage 2 over several processes.
+
+Stage 2 chunks are independent of each other, so ``Stage2Pool`` runs one
+process per entry of ``devices`` (``"cuda:0"``, ``"cuda:1"``, ... or
+``"cpu"`` several times), each with its own copy of the stage 2 model, and
+hands whole batches to whichever process is free. The int32 codes of a batch
+and the ids coming back are exchanged through shared memory blocks; only
+their names and the chunk lengths go through the queues.
+"""
+
+import multiprocessing
+import os
+import queue
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch
+
+# stage 2 ids per codebook 0 code
+frame_len = 8
+
+
+def shared_array(shm, size):
+    return np.ndarray((size,), dtype=np.int32, buffer=shm.buf)
+
+
+def run_task(decoder, device, codes_shm, ids_shm, lengths):
+    offsets = np.cumsum([0] + lengths)
+    codes = shared_array(codes_shm, sum(lengths))
+    chunks = [
+        torch.from_numpy(codes[start:end].copy())
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+    ids = shared_array(ids_shm, sum(lengths) * frame_len)
+    for start, output in zip(offsets, decoder.generate_chunks(chunks, device)):
+        ids[start * frame_len : start * frame_len + len(output)] = output.cpu().numpy()
+
+
+def worker(model_path, device, torch_dtype, num_threads, decoder_config, tasks, results):
+    from transformers import AutoModelForCausalLM
+
+    from stage2_decoder import Stage2Decoder
+
+    try:
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            torch_dtype=getattr(torch, torch_dtype),
+            attn_implementation="flash_attention_2" if device.startswith("cuda") else "sdpa",
+        )
+        model.to(device).eval()
+        decoder = Stage2Decoder(model, **decoder_config)
+    except BaseException:
+        results.put((None, traceback.format_exc()))
+        return
+    results.put((None, None))
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        index, codes_name, ids_name, lengths = task
+        error = None
+        blocks = []
+        try:
+            for name in (codes_name, ids_name):
+                blocks.append(shared_memory.SharedMemory(name=name))
+            run_task(decoder, device, *blocks, lengths)
+        except BaseException:
+            error = traceback.format_exc()
+        # the arrays on the blocks are gone with run_task's frame
+        for shm in blocks:
+            shm.close()
+        results.put((index, error))
+
+
+class Stage2Pool:
+    # seconds between checks that the workers are still alive while waiting
+    poll_seconds = 1.0
+
+    def __init__(self, model_path, devices, decoder_config, torch_dtype="bfloat16"):
+        context = multiprocessing.get_context("spawn")
+        self.devices = list(devices)
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        # tells the results of an imap call from those of an abandoned one
+        self.calls = 0
+        cpu_workers = sum(device == "cpu" for device in devices)
+        # CPU processes share the cores instead of each using all of them
+        num_threads = max(1, (os.cpu_count() or 1) // cpu_workers) if cpu_workers else 0
+        self.processes = [
+            context.Process(
+                target=worker,
+                args=(
+                    model_path,
+                    device,
+                    torch_dtype,
+                    num_threads if device == "cpu" else 0,
+                    decoder_config,
+                    self.tasks,
+                    self.results,
+                ),
+                daemon=True,
+            )
+            for device in devices
+        ]
+        for process in self.processes:
+            process.start()
+        for _ in self.processes:
+            try:
+                _, error = self.get_result()
+            except RuntimeError:
+                self.close()
+                raise
+            if error is not None:
+                self.close()
+                raise RuntimeError(f"Stage 2 worker failed to start:\n{error}")
+
+    def get_result(self):
+        """The next (index, error) a worker reports. A worker that dies (out
+        of memory, segfault) reports nothing, so this raises once one has
+        exited instead of waiting for it forever."""
+        while True:
+            # checked before waiting, so that what a worker sent before it
+            # exited is still read
+            dead = [
+                (device, process)
+                for device, process in zip(self.devices, self.processes)
+                if not process.is_alive()
+            ]
+            try:
+                return self.results.get(timeout=self.poll_seconds)
+            except queue.Empty:
+                if dead:
+                    device, process = dead[0]
+                    raise RuntimeError(
+                        f"Stage 2 worker on {device} exited with code {process.exitcode}"
+                    )
+
+    def imap(self, batches):
+        """The outputs of every batch of chunk codes, in order, like
+        ``map(stage2_generate, batches)``. All batches are queued at once and
+        taken by the workers as they become free."""
+        self.calls += 1
+        call = self.calls
+        blocks = []
+        try:
+            for index, chunks in enumerate(batches):
+                lengths = [len(chunk) for chunk in chunks]
+                codes_shm = shared_memory.SharedMemory(create=True, size=4 * sum(lengths))
+                ids_shm = shared_memory.SharedMemory(
+                    create=True, size=4 * sum(lengths) * frame_len
+                )
+                blocks.append((codes_shm, ids_shm, lengths, chunks[0].device))
+                codes = shared_array(codes_shm, sum(lengths))
+                codes[:] = torch.cat(chunks).cpu().numpy().astype(np.int32)
+                del codes
+                self.tasks.put(((call, index), codes_shm.name, ids_shm.name, lengths))
+
+            done = {}
+            for index, (codes_shm, ids_shm, lengths, device) in enumerate(blocks):
+                while (call, index) not in done:
+                    done_index, error = self.get_result()
+                    if done_index[0] != call:
+                        continue
+                    if error is not None:
+                        raise RuntimeError(f"Stage 2 worker failed:\n{error}")
+                    done[done_index] = True
+                ids = torch.from_numpy(
+                    shared_array(ids_shm, sum(lengths) * frame_len).astype(np.int64)
+                ).to(device)
+                offsets = np.cumsum([0] + lengths) * frame_len
+                yield [ids[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        finally:
+            for codes_shm, ids_shm, _, _ in blocks:
+                for shm in (codes_shm, ids_shm):
+                    shm.close()
+                    shm.unlink()
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
@@ -0,0 +1,71 @@
+"""Batches the stage 2 chunks of many tracks together.
+
+Stage 2 works on chunks of up to 6 seconds (300 frames) of codebook 0 codes.
+Instead of running every track on its own, with a batch of one for its
+ragged tail, the chunks of all tracks (both stems, every variation, every
+song that is ready) go into one list that is cut into batches longest first.
+Batches then only mix lengths where the full chunks meet the tails and among
+the tails, and only the last batch can be short.
+"""
+
+from collections import namedtuple
+
+import torch
+
+chunk_frames = 300  # 6 seconds of xcodec frames
+
+# ``codes``: the (T,) codebook 0 codes tensor of a chunk of track ``track``
+Stage2Chunk = namedtuple("Stage2Chunk", "track codes")
+
+
+def split_chunks(track, codes, chunk_frames=chunk_frames):
+    """The chunks of ``codes`` (T,) in order: full ones and a shorter tail."""
+    return [
+        Stage2Chunk(track, codes[start : start + chunk_frames])
+        for start in range(0, len(codes), chunk_frames)
+    ]
+
+
+def run_chunks(chunks, batch_size, generate, progress=iter, cache=None, imap=None):
+    """Run ``generate`` (a list of chunk codes to a list of their outputs) on
+    batches of at most ``batch_size`` chunks and return the outputs of every
+    track, concatenated in chunk order, by track number. With a ChunkCache,
+    chunks it holds are not generated, chunks with the same codes are only
+    generated once and every batch is stored as soon as it is done.
+    ``imap`` (e.g. ``Stage2Pool.imap``) replaces ``map(generate, batches)``."""
+    outputs = [None] * len(chunks)
+    keys = [None] * len(chunks)
+    # the chunks to generate, by key; only the first of each is generated
+    todo = {}
+    for i, chunk in enumerate(chunks):
+        if cache is not None:
+            keys[i] = cache.key(chunk.codes)
+            outputs[i] = cache.get(keys[i], chunk.codes.device)
+            if outputs[i] is not None:
+                continue
+        todo.setdefault(i if keys[i] is None else keys[i], []).append(i)
+    if cache is not None:
+        print(
+            f"Stage 2: {sum(output is not None for output in outputs)} of "
+            f"{len(chunks)} chunks cached, {len(todo)} to decode."
+        )
+
+    order = sorted(
+        (same[0] for same in todo.values()), key=lambda i: -len(chunks[i].codes)
+    )
+    batches = [order[start : start + batch_size] for start in range(0, len(order), batch_size)]
+    batch_codes = [[chunks[i].codes for i in batch] for batch in batches]
+    results = map(generate, batch_codes) if imap is None else imap(batch_codes)
+    for batch, batch_outputs in zip(progress(batches), results):
+        for i, output in zip(batch, batch_outputs):
+            for j in todo[i if keys[i] is None else keys[i]]:
+                outputs[j] = output
+            if cache is not None:
+                cache.put(keys[i], output)
+    if cache is not None:
+        cache.trim()
+
+    tracks = {}
+    for chunk, output in zip(chunks, outputs):
+        tracks.setdefault(chunk.track, []).append(output)
+    return {track: torch.cat(outputs) for track, outputs in tracks.items()}
@@ -112,6 +112,8 @@ class SoundStream(nn.Module):
         # self.fc_prior= nn.Linear( D, D )
         self.fc_post1= nn.Linear( D+768, 768 )
         self.fc_post2= nn.Linear( D+768,  D)
+        # fc_post2 of every code vector, see build_decode_table
+        self.register_buffer("decode_table", None, persistent=False)
 
     def get_last_layer(self):
         return self.decoder.layers[-1].weight
@@ -130,12 +132,31 @@ class SoundStream(nn.Module):
     def get_regress_target(self, x ):
         x= x[:,0,:]
         x = F.pad(x, (160, 160))
-        target = self.semantic_model(x, output_hidden_states=True) .hidden_states
-        target = torch.stack(target, dim=1)#.transpose(-1, -2)#.flatten(start_dim=1, end_dim=2)
-        
-        target = target.mean(1)   
-        # target = target[9]
-        return target
+        # mean of all hidden states (the input of every layer and the last
+        # output), summed up as the layers run instead of stacked
+        layers = self.semantic_model.encoder.layers
+        target = None
+
+        def add_hidden(module, args, kwargs):
+            nonlocal target
+            hidden = args[0] if args else kwargs["hidden_states"]
+            target = hidden.clone() if target is None else target.add_(hidden)
+
+        handles = [layer.register_forward_pre_hook(add_hidden, with_kwargs=True) for layer in layers]
+        try:
+            last = self.semantic_model(x).last_hidden_state
+        finally:
+            for handle in handles:
+                handle.remove()
+        return target.add_(last) / (len(layers) + 1)
+
+    def acoustic_frames(self, num_samples):
+        """Frames the acoustic encoder makes of ``num_samples`` samples."""
+        length = num_samples
+        for conv in self.encoder.modules():
+            if isinstance(conv, nn.Conv1d):
+                length = (length + 2 * conv.padding[0] - conv.dilation[0] * (conv.kernel_size[0] - 1) - 1) // conv.stride[0] + 1
+        return length
 
  
     def forward(self, x: torch.Tensor, bw: int):
@@ -179,12 +200,12 @@ class SoundStream(nn.Module):
         e_semantic_input = self.get_regress_target(x).detach()
 
         e_semantic = self.encoder_semantic(e_semantic_input.transpose(1, 2))
-        e_acoustic = self.encoder(x)
 
-
-        if e_acoustic.shape[2] != e_semantic.shape[2]:
-            # e_acoustic = self.encoder(F.pad(x[:,0,:], (160, 160)).unsqueeze(0)) 
-            e_acoustic = self.encoder(torch.transpose(F.pad(x[:,0,:], (160, 160)).unsqueeze(0), 0, 1))
+        # pad like the semantic input if that is what makes the frames match,
+        # rather than encoding twice
+        if self.acoustic_frames(x.shape[-1]) != e_semantic.shape[2]:
+            x = F.pad(x, (160, 160))
+        e_acoustic = self.encoder(x)
  
         e= torch.cat([e_acoustic, e_semantic], dim=1)
 
@@ -196,9 +217,40 @@ class SoundStream(nn.Module):
     def get_embed(self, codes: torch.Tensor) -> torch.Tensor:
         return self.quantizer.decode(codes)
 
+    @torch.no_grad()
+    def build_decode_table(self):
+        """Apply fc_post2 ahead of time to the code vectors of every codebook.
+        Since it is linear, ``decode`` then gets the decoder input of codes with
+        one gather and sum (``decode_input``) instead of quantizer.decode and
+        fc_post2. Build it again after changing the weights."""
+        bins = 1 << self.bits_per_codebook
+        device = self.fc_post2.weight.device
+        vectors = []
+        for k in range(self.n_q):
+            codes = torch.zeros((k + 1, 1, bins), dtype=torch.long, device=device)
+            codes[k, 0] = torch.arange(bins, device=device)
+            # quantizer.decode sums one lookup per codebook: take off the
+            # ones of codebooks 0..k-1
+            vector = self.quantizer.decode(codes)
+            if k > 0:
+                vector = vector - self.quantizer.decode(codes[:k, :, :1])
+            vectors.append(vector[0].T)
+        self.decode_table = F.linear(torch.cat(vectors), self.fc_post2.weight)
+
+    def decode_input(self, codes: torch.Tensor) -> torch.Tensor:
+        """fc_post2(quantizer.decode(codes)) from the decode table."""
+        n_q, batch, frames = codes.shape
+        bins = 1 << self.bits_per_codebook
+        index = codes + bins * torch.arange(n_q, device=codes.device)[:, None, None]
+        e = F.embedding_bag(index.permute(1, 2, 0).reshape(-1, n_q), self.decode_table, mode="sum")
+        return (e + self.fc_post2.bias).view(batch, frames, -1).transpose(1, 2)
+
     def decode(self, codes: torch.Tensor) -> torch.Tensor:
-        quantized = self.quantizer.decode(codes)
-        quantized_acoustic = self.fc_post2(quantized.transpose(1, 2)).transpose(1, 2)
+        if self.decode_table is not None:
+            quantized_acoustic = self.decode_input(codes)
+        else:
+            quantized = self.quantizer.decode(codes)
+            quantized_acoustic = self.fc_post2(quantized.transpose(1, 2)).transpose(1, 2)
 
         o = self.decoder_2(quantized_acoustic)
         return o
@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+inference_dir = Path(__file__).resolve().parent.parent / "inference"
+# the inference modules import each other as top level modules, and the
+# xcodec ones import its packages (descriptaudiocodec, quantization, ...)
+sys.path.append(str(inference_dir))
+sys.path.append(str(inference_dir / "xcodec_mini_infer"))
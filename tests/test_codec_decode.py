@@ -0,0 +1,48 @@
+"""decode_chunked against a whole-track decode, with the DAC decoder of
+xcodec at random weights and small sizes on CPU."""
+
+import pytest
+import torch
+
+from codec_decode import decode_batch, decode_chunked
+
+dac2 = pytest.importorskip("descriptaudiocodec.dac.model.dac")
+
+hop_length = 320
+window_frames = 40
+context_frames = 20
+overlap_frames = 5
+
+
+@pytest.fixture(scope="module")
+def decode():
+    torch.manual_seed(0)
+    decoder = dac2.Decoder(16, 32, [8, 5, 4, 2]).eval()
+    codebooks = torch.randn(8, 1024, 16)
+    codebook_index = torch.arange(8)[:, None, None]
+
+    def decode(codes):
+        # (n_q, B, T) codes to the audio of the sum of their code vectors
+        with torch.no_grad():
+            return decoder(codebooks[codebook_index, codes].sum(0).transpose(1, 2))
+
+    return decode
+
+
+# not a multiple of the window, and just over one window and its overlap
+@pytest.mark.parametrize("num_frames", [97, window_frames + overlap_frames + 1])
+def test_decode_chunked_matches_whole_track(decode, num_frames):
+    torch.manual_seed(num_frames)
+    codes = torch.randint(0, 1024, (8, 2, num_frames))
+    chunked = decode_chunked(decode, codes, hop_length, window_frames, context_frames, overlap_frames)
+    full = decode(codes)
+    assert chunked.shape == full.shape
+    assert torch.allclose(chunked, full, atol=1e-5)
+
+
+def test_decode_batch_matches_tracks_alone(decode):
+    torch.manual_seed(1)
+    tracks = [torch.randint(0, 1024, (8, num_frames)) for num_frames in (97, 46, 30, 120)]
+    outputs = decode_batch(decode, tracks, hop_length, 3, window_frames, context_frames, overlap_frames)
+    for codes, audio in zip(tracks, outputs):
+        assert torch.allclose(audio, decode(codes[:, None])[0], atol=1e-5)
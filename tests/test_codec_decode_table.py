@@ -0,0 +1,43 @@
+"""SoundStream.decode_input (the fused decode table) against quantizer.decode
+followed by fc_post2, on random weights on CPU."""
+
+import pytest
+import torch
+from torch import nn
+
+soundstream = pytest.importorskip("models.soundstream_hubert_new")
+from quantization import ResidualVectorQuantizer
+
+n_q = 12
+dimension = 64
+
+
+@pytest.fixture(scope="module")
+def codec():
+    torch.manual_seed(0)
+    # SoundStream() loads the HuBERT checkpoint, only the decode path is built
+    codec = soundstream.SoundStream.__new__(soundstream.SoundStream)
+    nn.Module.__init__(codec)
+    codec.n_q = n_q
+    codec.bits_per_codebook = 10
+    codec.quantizer = ResidualVectorQuantizer(dimension=dimension, n_q=n_q, bins=1024)
+    # the codebooks are zero until the kmeans init of training
+    for name, buffer in codec.quantizer.named_buffers():
+        if name.endswith("embed"):
+            buffer.normal_()
+    codec.fc_post2 = nn.Linear(dimension, 16)
+    codec.register_buffer("decode_table", None, persistent=False)
+    codec.eval()
+    codec.build_decode_table()
+    return codec
+
+
+# all codebooks, the 8 stage 2 decodes, and the 1 of stage 1
+@pytest.mark.parametrize("num_codebooks", [n_q, 8, 1])
+def test_decode_input_matches_quantizer_decode(codec, num_codebooks):
+    torch.manual_seed(num_codebooks)
+    codes = torch.randint(0, 1024, (num_codebooks, 2, 30))
+    with torch.no_grad():
+        quantized = codec.quantizer.decode(codes)
+        expected = codec.fc_post2(quantized.transpose(1, 2)).transpose(1, 2)
+        assert torch.allclose(codec.decode_input(codes), expected, atol=1e-5)
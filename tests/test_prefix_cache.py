@@ -0,0 +1,78 @@
+"""PrefixCache on small random KV caches: RAM hits, spilling the least
+recently used entries to disk and reading them back."""
+
+import os
+
+import torch
+
+from prefix_cache import PrefixCache, layers_nbytes
+from stage1_context import cache_from_layers, cache_layers
+
+model_name = "model|bf16|not requantized|sdpa"
+
+
+def random_cache(length):
+    return cache_from_layers(
+        [[torch.randn(1, 2, length, 4), torch.randn(1, 2, length, 4)] for _ in range(2)]
+    )
+
+
+def entry_bytes(length):
+    return layers_nbytes(cache_layers(random_cache(length)))
+
+
+def assert_same(cache, expected):
+    assert cache is not None
+    for (k, v), (expected_k, expected_v) in zip(cache_layers(cache), cache_layers(expected)):
+        assert torch.equal(k, expected_k)
+        assert torch.equal(v, expected_v)
+
+
+def test_put_get_in_ram(tmp_path):
+    prefix_cache = PrefixCache(10 * entry_bytes(10), str(tmp_path), 0)
+    ids = torch.arange(10)[None]
+    cache = random_cache(10)
+    prefix_cache.put(model_name, ids, cache)
+    assert_same(prefix_cache.get(model_name, ids, "cpu"), cache)
+    # keyed by the model (its quantization, its attention kernel) and the ids
+    assert prefix_cache.get("model|int8|not requantized|sdpa", ids, "cpu") is None
+    assert prefix_cache.get(model_name, ids + 1, "cpu") is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_evicted_entries_spill_to_disk_and_reload(tmp_path):
+    # room for one entry in RAM
+    prefix_cache = PrefixCache(entry_bytes(10) * 3 // 2, str(tmp_path), 2**20)
+    first_ids, second_ids = torch.arange(10)[None], torch.arange(1, 11)[None]
+    first, second = random_cache(10), random_cache(10)
+    prefix_cache.put(model_name, first_ids, first)
+    prefix_cache.put(model_name, second_ids, second)
+    first_key = PrefixCache.key(model_name, first_ids)
+    assert list(prefix_cache.entries) == [PrefixCache.key(model_name, second_ids)]
+    assert os.path.exists(prefix_cache.disk_path(first_key))
+
+    # read back from disk into RAM, which spills the second one in turn
+    assert_same(prefix_cache.get(model_name, first_ids, "cpu"), first)
+    assert list(prefix_cache.entries) == [first_key]
+    # a new process finds both on disk
+    reloaded = PrefixCache(entry_bytes(10) * 3, str(tmp_path), 2**20)
+    assert_same(reloaded.get(model_name, first_ids, "cpu"), first)
+    assert_same(reloaded.get(model_name, second_ids, "cpu"), second)
+
+
+def test_disk_is_trimmed_to_its_budget(tmp_path):
+    # nothing stays in RAM and the disk holds one entry
+    prefix_cache = PrefixCache(0, str(tmp_path), entry_bytes(10) * 3 // 2)
+    for start in range(3):
+        prefix_cache.put(model_name, torch.arange(start, start + 10)[None], random_cache(10))
+    assert os.listdir(tmp_path) == [os.path.basename(
+        prefix_cache.disk_path(PrefixCache.key(model_name, torch.arange(2, 12)[None]))
+    )]
+
+
+def test_no_disk_budget_drops_evicted_entries(tmp_path):
+    prefix_cache = PrefixCache(0, str(tmp_path), 0)
+    ids = torch.arange(10)[None]
+    prefix_cache.put(model_name, ids, random_cache(10))
+    assert prefix_cache.get(model_name, ids, "cpu") is None
+    assert os.listdir(tmp_path) == []
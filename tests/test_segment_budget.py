@@ -0,0 +1,39 @@
+"""plan_budgets on split_lyrics style segments."""
+
+from segment_budget import budget_report, estimate_tokens, min_budget_tokens, plan_budgets
+
+# 2 lines of 3 words: 2 * (3 / 1.5 + 1) seconds
+verse = "[verse]\nHello there world\nAnother sung line\n\n"
+# 4 characters: 4 / 3 + 1 seconds
+chorus = "[chorus]\n你好世界\n\n"
+intro = "[intro]\n\n\n"
+long_verse = "[verse]\n" + "one two three four five six\n" * 20 + "\n"
+segments = [verse, chorus, intro, long_verse]
+
+
+def test_estimates():
+    assert estimate_tokens(verse) == 600
+    assert estimate_tokens(chorus) == 233
+    # sections without lyrics get a fixed length by type
+    assert estimate_tokens(intro) == 1500
+    assert estimate_tokens(long_verse) == 10000
+
+
+def test_no_cap_without_margin():
+    for margin in (None, 0):
+        budgets = plan_budgets(segments, 3000, margin)
+        assert [b.max_new_tokens for b in budgets] == [3000] * 4
+        assert [b.section for b in budgets] == ["verse", "chorus", "intro", "verse"]
+        assert [b.estimate for b in budgets] == [600, 233, 1500, 10000]
+
+
+def test_margin_caps_between_minimum_and_max_new_tokens():
+    budgets = plan_budgets(segments, 3000, 1.5)
+    assert [b.max_new_tokens for b in budgets] == [900, min_budget_tokens, 2250, 3000]
+
+
+def test_report_marks_segments_at_their_limit():
+    budgets = plan_budgets(segments[:2], 3000, 1.5)
+    lines = budget_report(budgets, [[900, 850], [120]]).splitlines()
+    assert lines[1] == "  0: [verse] 600 / 900 / 900, 850 (limit reached)"
+    assert lines[2] == "  1: [chorus] 233 / 500 / 120"
@@ -0,0 +1,69 @@
+"""The HuBERT layer mean and the acoustic frame count SoundStream.encode
+relies on, with small randomly initialised models on CPU."""
+
+import pytest
+import torch
+import transformers
+from torch import nn
+from transformers import HubertConfig, HubertModel
+
+soundstream = pytest.importorskip("models.soundstream_hubert_new")
+
+ratios = [8, 5, 4, 2]
+
+
+def bare_soundstream():
+    # SoundStream() loads the HuBERT checkpoint, the modules are set by hand
+    codec = soundstream.SoundStream.__new__(soundstream.SoundStream)
+    nn.Module.__init__(codec)
+    return codec
+
+
+@pytest.mark.parametrize(
+    "do_stable_layer_norm",
+    [
+        False,
+        pytest.param(
+            True,
+            marks=pytest.mark.skipif(
+                int(transformers.__version__.split(".")[0]) >= 5,
+                reason="transformers 5 ends the hidden states of stable layer norm models "
+                "with the last layer's output before the final layer norm",
+            ),
+        ),
+    ],
+)
+def test_regress_target_is_mean_of_hidden_states(do_stable_layer_norm):
+    torch.manual_seed(0)
+    config = HubertConfig(
+        hidden_size=32,
+        num_hidden_layers=3,
+        num_attention_heads=4,
+        intermediate_size=64,
+        conv_dim=(16,) * 7,
+        num_conv_pos_embeddings=16,
+        num_conv_pos_embedding_groups=4,
+        do_stable_layer_norm=do_stable_layer_norm,
+        feat_extract_norm="layer" if do_stable_layer_norm else "group",
+    )
+    codec = bare_soundstream()
+    codec.semantic_model = HubertModel(config).eval()
+    x = torch.randn(2, 1, 8000)
+    with torch.no_grad():
+        # what get_regress_target computed before it summed the layers on hooks
+        hidden_states = codec.semantic_model(
+            torch.nn.functional.pad(x[:, 0], (160, 160)), output_hidden_states=True
+        ).hidden_states
+        expected = torch.stack(hidden_states, dim=1).mean(1)
+        target = codec.get_regress_target(x)
+    assert torch.allclose(target, expected, atol=1e-5)
+
+
+def test_acoustic_frames_match_encoder():
+    torch.manual_seed(0)
+    codec = bare_soundstream()
+    codec.encoder = soundstream.dac2.Encoder(8, ratios, 16).eval()
+    for num_samples in (319, 320, 321, 960, 1279, 16000, 16001, 16159, 16160, 16320):
+        with torch.no_grad():
+            frames = codec.encoder(torch.zeros(1, 1, num_samples)).shape[-1]
+        assert codec.acoustic_frames(num_samples) == frames, num_samples
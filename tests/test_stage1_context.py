@@ -0,0 +1,121 @@
+"""SegmentContext on a tiny random Llama on CPU: sampling segment after
+segment on the carried KV cache against prefilling the whole context again
+for every segment, and evicting old segments from the cache."""
+
+import pytest
+import torch
+from transformers import DynamicCache, LlamaConfig, LlamaForCausalLM
+
+from stage1_context import SegmentContext, cache_layers, evict_cache_span, rotary_inv_freq
+from stage1_sampler import Stage1Sampler
+
+vocab_size = 64
+eos_token_id = 63
+head = [1, 2, 3, 4, 5, 6]
+# the first prompt follows the head, the later ones close the previous
+# segment (eos, one token) and open the next
+segment_prompts = [[10, 11, 12], [63, 13, 14, 15], [63, 16, 17]]
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=vocab_size,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=256,
+    )
+    config._attn_implementation = "eager"
+    return LlamaForCausalLM(config).eval()
+
+
+def sample_song(model, num_variations, reuse_cache):
+    """The ids of every variation after all segments, sampled as
+    stage1_inference does; without ``reuse_cache`` every segment prefills
+    its whole context."""
+    sampler = Stage1Sampler(model, eos_token_id)
+    torch.manual_seed(1)
+    contexts = []
+    for i, segment in enumerate(segment_prompts):
+        prompt_ids = torch.tensor([segment])
+        if i == 0:
+            context = SegmentContext(rotary_inv_freq(model))
+            prompt_ids = torch.tensor([head + segment])
+            context.add_segment(prompt_ids, len(head), head_len=len(head))
+            sampler.prefill(context)
+            contexts = [context] + [context.fork() for _ in range(num_variations - 1)]
+        else:
+            for context in contexts:
+                context.add_segment(prompt_ids, 1)
+        if not reuse_cache:
+            for context in contexts:
+                context.past_key_values = None
+        new_ids_list, caches = sampler.sample_batch(contexts, 1.5, 10, min_new_tokens=4)
+        for context, new_ids, cache in zip(contexts, new_ids_list, caches):
+            if new_ids[0, -1].item() != eos_token_id:
+                new_ids = torch.cat([new_ids, torch.tensor([[eos_token_id]])], dim=1)
+            context.update(torch.cat([context.ids, new_ids], dim=1), cache)
+    return contexts
+
+
+@pytest.mark.parametrize("num_variations", [1, 2])
+def test_reused_cache_matches_prefill(model, num_variations):
+    reused = sample_song(model, num_variations, reuse_cache=True)
+    prefilled = sample_song(model, num_variations, reuse_cache=False)
+    if num_variations > 1:
+        # the forks sampled on their own
+        assert not torch.equal(reused[0].ids, reused[1].ids)
+    for context, expected in zip(reused, prefilled):
+        assert torch.equal(context.ids, expected.ids)
+        # the carried cache is the one a fresh prefill of the song gives
+        cached = context.past_key_values.get_seq_length()
+        with torch.no_grad():
+            fresh = model(context.ids[:, :cached], past_key_values=DynamicCache()).past_key_values
+        for (k, v), (fresh_k, fresh_v) in zip(
+            cache_layers(context.past_key_values), cache_layers(fresh)
+        ):
+            assert torch.allclose(k, fresh_k, atol=1e-5)
+            assert torch.allclose(v, fresh_v, atol=1e-5)
+
+
+def prefill(model, ids):
+    with torch.no_grad():
+        return model(ids, past_key_values=DynamicCache()).past_key_values
+
+
+def test_evicted_layer0_matches_prefill(model):
+    torch.manual_seed(2)
+    ids = torch.randint(0, vocab_size, (1, 40))
+    cache = prefill(model, ids)
+    evict_cache_span(cache, 8, 20, rotary_inv_freq(model))
+    kept = torch.cat([ids[:, :8], ids[:, 20:]], dim=1)
+    # The rotated back keys of layer 0 are those of the kept tokens at their
+    # new positions. Deeper layers saw the evicted tokens and only
+    # approximate a prefill of the kept ones, so they are not compared.
+    (k, v), (fresh_k, fresh_v) = cache_layers(cache)[0], cache_layers(prefill(model, kept))[0]
+    assert k.shape == fresh_k.shape
+    assert torch.allclose(k, fresh_k, atol=1e-5)
+    assert torch.allclose(v, fresh_v, atol=1e-5)
+
+
+def test_compact_evicts_oldest_segments(model):
+    sampler = Stage1Sampler(model, eos_token_id)
+    context = SegmentContext(rotary_inv_freq(model))
+    context.add_segment(torch.tensor([head + [10, 11, 12, 20, 21, 22, 23, eos_token_id]]), 6, head_len=6)
+    for segment in ([63, 13, 14, 30, 31, 32, 33, 34, eos_token_id], [63, 15, 16, 40, 41]):
+        context.add_segment(torch.tensor([segment]), 1)
+    sampler.prefill(context)
+    ids = context.ids
+    assert context.segment_starts == [6, 15, 24]
+    # room for the head and the last two segments
+    assert context.compact(len(ids[0]) - 8) == 1
+    expected = torch.cat([ids[:, :6], ids[:, 15:]], dim=1)
+    assert torch.equal(context.ids, expected)
+    assert context.segment_starts == [6, 15]
+    k, _ = cache_layers(context.past_key_values)[0]
+    fresh_k, _ = cache_layers(prefill(model, expected[:, :-1]))[0]
+    assert torch.allclose(k, fresh_k, atol=1e-5)
@@ -0,0 +1,98 @@
+"""Stage1Sampler against transformers' generate with guidance_scale, and a
+left padded batch of contexts against sampling each of them alone, on a tiny
+random Llama on CPU."""
+
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from stage1_context import SegmentContext, cache_layers, rotary_inv_freq
+from stage1_sampler import Stage1Sampler
+
+vocab_size = 64
+eos_token_id = 63
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=vocab_size,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=256,
+    )
+    config._attn_implementation = "eager"
+    model = LlamaForCausalLM(config).eval()
+    with torch.no_grad():
+        # peakier distributions, so that top-k and top-p cut something
+        model.lm_head.weight.mul_(20)
+    return model
+
+
+def new_context(model, ids):
+    context = SegmentContext(rotary_inv_freq(model))
+    context.add_segment(ids, 0)
+    return context
+
+
+@pytest.mark.parametrize("guidance_scale", [None, 1.5])
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_sample_matches_generate(model, guidance_scale, seed):
+    torch.manual_seed(10 + seed)
+    prompt = torch.randint(0, eos_token_id, (1, 20))
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        expected = model.generate(
+            input_ids=prompt,
+            max_new_tokens=30,
+            min_new_tokens=10,
+            do_sample=True,
+            top_p=0.93,
+            top_k=50,
+            temperature=1.0,
+            eos_token_id=eos_token_id,
+            pad_token_id=eos_token_id,
+            guidance_scale=guidance_scale,
+        )[:, prompt.shape[-1] :]
+    torch.manual_seed(seed)
+    sampler = Stage1Sampler(model, eos_token_id)
+    new_ids, _ = sampler.sample(new_context(model, prompt), guidance_scale, 30, 10)
+    assert torch.equal(new_ids, expected)
+
+
+def stop_after(token):
+    """A logits processor forcing eos after ``token``, so that the rows of a
+    batch end at different steps."""
+
+    def processor(ids, scores):
+        stop = ids[:, -1] == token
+        scores = scores.masked_fill(stop[:, None], -float("inf"))
+        scores[stop, eos_token_id] = 0
+        return scores
+
+    return processor
+
+
+@pytest.mark.parametrize("guidance_scale", [None, 1.5])
+def test_left_padded_batch_matches_single_rows(model, guidance_scale):
+    # top_k=1 takes the argmax, so that the rows do not depend on how the
+    # random numbers are drawn for a batch and for a single row
+    sampler = Stage1Sampler(model, eos_token_id, top_k=1, logits_processor=[stop_after(44)])
+    torch.manual_seed(3)
+    prompts = [torch.randint(0, eos_token_id, (1, length)) for length in (12, 5, 8)]
+    batch_ids, batch_caches = sampler.sample_batch(
+        [new_context(model, prompt) for prompt in prompts], guidance_scale, 15
+    )
+    assert len({ids.shape[-1] for ids in batch_ids}) > 1
+    for prompt, ids, cache in zip(prompts, batch_ids, batch_caches):
+        row_ids, row_cache = sampler.sample(new_context(model, prompt), guidance_scale, 15)
+        assert torch.equal(ids, row_ids)
+        # padding is dropped from the cache handed back for the row
+        for (k, v), (row_k, row_v) in zip(cache_layers(cache), cache_layers(row_cache)):
+            assert k.shape == row_k.shape
+            assert torch.allclose(k, row_k, atol=1e-5)
+            assert torch.allclose(v, row_v, atol=1e-5)
@@ -0,0 +1,100 @@
+"""SpeculativeStage1Sampler against the distribution of the target model
+alone, on tiny random Llamas on CPU."""
+
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from stage1_context import SegmentContext, rotary_inv_freq
+from stage1_sampler import Stage1Sampler
+from stage1_speculative import SpeculativeStage1Sampler
+
+vocab_size = 8
+# never sampled, min_new_tokens covers all new tokens
+eos_token_id = vocab_size - 1
+prompt = torch.tensor([[1, 4, 2, 5, 3]])
+
+
+def tiny_llama(seed):
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=vocab_size,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=1,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=64,
+    )
+    config._attn_implementation = "eager"
+    model = LlamaForCausalLM(config).eval()
+    with torch.no_grad():
+        # peaked distributions, so that draft and target disagree
+        model.lm_head.weight.mul_(10)
+    return model
+
+
+@pytest.fixture(scope="module")
+def target():
+    return tiny_llama(0)
+
+
+@pytest.fixture(scope="module")
+def draft():
+    return tiny_llama(1)
+
+
+def new_context(model):
+    context = SegmentContext(rotary_inv_freq(model))
+    context.add_segment(prompt, 0)
+    return context
+
+
+@torch.no_grad()
+def next_token_probs(sampler, ids, guidance_scale):
+    """The distribution Stage1Sampler samples the token after ``ids`` from."""
+    n_new = ids.shape[-1] - prompt.shape[-1]
+    cond_logits = sampler.model(ids).logits[:, -1].float()
+    uncond_logits = None
+    if guidance_scale is not None:
+        # the unconditional sequence starts from the last prompt token
+        uncond_logits = sampler.model(ids[:, prompt.shape[-1] - 1 :]).logits[:, -1].float()
+    scores = sampler.process(ids, cond_logits, uncond_logits, guidance_scale, n_new, 2)
+    return torch.softmax(scores, dim=-1)[0]
+
+
+def two_token_probs(model, guidance_scale):
+    sampler = Stage1Sampler(model, eos_token_id)
+    probs = torch.zeros(vocab_size, vocab_size)
+    first = next_token_probs(sampler, prompt, guidance_scale)
+    for token in first.nonzero()[:, 0].tolist():
+        ids = torch.cat([prompt, torch.tensor([[token]])], dim=1)
+        probs[token] = first[token] * next_token_probs(sampler, ids, guidance_scale)
+    return probs
+
+
+@pytest.mark.parametrize("guidance_scale", [None, 1.5])
+def test_speculative_keeps_target_distribution(target, draft, guidance_scale):
+    expected = two_token_probs(target, guidance_scale)
+    # the test means something only if sampling the draft would be wrong
+    assert (expected - two_token_probs(draft, guidance_scale)).abs().sum() / 2 > 0.3
+
+    sampler = SpeculativeStage1Sampler(target, draft, eos_token_id, num_draft_tokens=1)
+    torch.manual_seed(2)
+    counts = torch.zeros(vocab_size, vocab_size)
+    num_samples = 1000
+    for _ in range(num_samples):
+        ids, _ = sampler.sample(new_context(target), guidance_scale, 2, min_new_tokens=2)
+        counts[ids[0, 0], ids[0, 1]] += 1
+    assert sampler.stats["accepted"] < sampler.stats["proposed"]
+    # total variation distance to the target's own distribution
+    assert (counts / num_samples - expected).abs().sum() / 2 < 0.1
+
+
+def test_draft_equal_to_target_accepts_everything(target):
+    sampler = SpeculativeStage1Sampler(target, target, eos_token_id, num_draft_tokens=3)
+    torch.manual_seed(3)
+    ids, _ = sampler.sample(new_context(target), 1.5, 12, min_new_tokens=12)
+    assert ids.shape == (1, 12)
+    assert sampler.stats["accepted"] == sampler.stats["proposed"]
+    assert sampler.stats["tokens"] == 12
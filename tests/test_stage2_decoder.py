@@ -0,0 +1,96 @@
+"""Stage2Decoder against the per-frame model.generate loop it replaced, on a
+tiny random Llama on CPU."""
+
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM, LogitsProcessorList
+
+from stage2_decoder import Stage2Decoder
+
+code_offset = 100
+codebook_size = 16
+prompt_head = (1, 2)
+prompt_tail = (3,)
+# one allowed range for all 7 generated tokens, as the old blocked ranges
+wide_ranges = [(code_offset + codebook_size, code_offset + 8 * codebook_size)] * 7
+# the range of its own codebook for every generated token
+codebook_ranges = [
+    (code_offset + k * codebook_size, code_offset + (k + 1) * codebook_size) for k in range(1, 8)
+]
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=256,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=512,
+    )
+    config._attn_implementation = "eager"
+    return LlamaForCausalLM(config).eval()
+
+
+class AllowRanges:
+    """Masks all but ``code_ranges[k]`` for the k-th token generated after a
+    prompt of ``prompt_len`` tokens."""
+
+    def __init__(self, code_ranges, prompt_len):
+        self.code_ranges = code_ranges
+        self.prompt_len = prompt_len
+
+    def __call__(self, input_ids, scores):
+        start, end = self.code_ranges[input_ids.shape[1] - self.prompt_len]
+        mask = torch.full_like(scores, -float("inf"))
+        mask[:, start:end] = 0
+        return scores + mask
+
+
+def generate_loop(model, prompt_ids, codec_ids, code_ranges):
+    """The old stage2_generate: one model.generate call per frame on the
+    whole growing prompt."""
+    ids = prompt_ids
+    for frame in range(codec_ids.shape[1]):
+        ids = torch.cat([ids, codec_ids[:, frame : frame + 1]], dim=1)
+        with torch.no_grad():
+            ids = model.generate(
+                input_ids=ids,
+                min_new_tokens=7,
+                max_new_tokens=7,
+                do_sample=False,
+                pad_token_id=0,
+                logits_processor=LogitsProcessorList([AllowRanges(code_ranges, ids.shape[1])]),
+            )
+    return ids[:, prompt_ids.shape[1] :]
+
+
+def prompt(codes):
+    ids = codes + code_offset
+    return torch.cat([torch.tensor(prompt_head), ids, torch.tensor(prompt_tail)]), ids
+
+
+@pytest.mark.parametrize("code_ranges", [wide_ranges, codebook_ranges])
+def test_generate_matches_generate_loop(model, code_ranges):
+    torch.manual_seed(1)
+    prompts, codec_ids = zip(*(prompt(torch.randint(0, codebook_size, (10,))) for _ in range(2)))
+    prompt_ids, codec_ids = torch.stack(prompts), torch.stack(codec_ids)
+    decoder = Stage2Decoder(model, code_ranges)
+    expected = generate_loop(model, prompt_ids, codec_ids, code_ranges)
+    assert torch.equal(decoder.generate(prompt_ids, codec_ids), expected)
+
+
+@pytest.mark.parametrize("code_ranges", [wide_ranges, codebook_ranges])
+def test_generate_chunks_left_padded_tails(model, code_ranges):
+    torch.manual_seed(2)
+    chunks = [torch.randint(0, codebook_size, (length,)) for length in (10, 4, 10, 7)]
+    decoder = Stage2Decoder(model, code_ranges, prompt_head, prompt_tail, code_offset)
+    outputs = decoder.generate_chunks(chunks, "cpu")
+    for chunk, output in zip(chunks, outputs):
+        # each chunk on its own, as the old loop ran the tails
+        prompt_ids, codec_ids = prompt(chunk)
+        expected = generate_loop(model, prompt_ids[None], codec_ids[None], code_ranges)
+        assert torch.equal(output, expected[0])
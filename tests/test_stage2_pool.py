@@ -0,0 +1,80 @@
+"""Stage2Pool against Stage2Decoder in this process, on a tiny random Llama
+saved to a temporary folder, with CPU worker processes."""
+
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from stage2_decoder import Stage2Decoder
+from stage2_pool import Stage2Pool
+from stage2_scheduler import run_chunks, split_chunks
+
+code_offset = 100
+codebook_size = 16
+decoder_config = dict(
+    code_ranges=[
+        (code_offset + k * codebook_size, code_offset + (k + 1) * codebook_size)
+        for k in range(1, 8)
+    ],
+    prompt_head=(1, 2),
+    prompt_tail=(3,),
+    code_offset=code_offset,
+)
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=256,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=512,
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+@pytest.fixture(scope="module")
+def model_dir(model, tmp_path_factory):
+    path = tmp_path_factory.mktemp("stage2_model")
+    model.save_pretrained(path)
+    return str(path)
+
+
+@pytest.fixture(scope="module")
+def chunks():
+    torch.manual_seed(1)
+    # two tracks, each with full chunks and a shorter tail
+    return split_chunks(0, torch.randint(0, codebook_size, (25,)), 8) + split_chunks(
+        1, torch.randint(0, codebook_size, (13,)), 8
+    )
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_pool_matches_in_process(model, model_dir, chunks, workers):
+    decoder = Stage2Decoder(model, **decoder_config)
+    expected = run_chunks(chunks, 2, lambda batch: decoder.generate_chunks(batch, "cpu"))
+    pool = Stage2Pool(model_dir, ["cpu"] * workers, decoder_config, torch_dtype="float32")
+    try:
+        outputs = run_chunks(chunks, 2, None, imap=pool.imap)
+    finally:
+        pool.close()
+    assert outputs.keys() == expected.keys()
+    for track in expected:
+        assert torch.equal(outputs[track], expected[track])
+
+
+def test_dead_worker_raises(model_dir, chunks):
+    pool = Stage2Pool(model_dir, ["cpu"], decoder_config, torch_dtype="float32")
+    pool.poll_seconds = 0.1
+    try:
+        # as if it had been killed for running out of memory
+        pool.processes[0].kill()
+        pool.processes[0].join()
+        with pytest.raises(RuntimeError, match="exited with code"):
+            run_chunks(chunks, 2, None, imap=pool.imap)
+    finally:
+        pool.close()